@@ -1,8 +1,7 @@
 import typing
-from polars import from_dicts
 from prefect.serializers import Serializer, Literal
 
-from Code.Data.account_data import Account
+from Code.Data.account_data import Account, encode_frame, encode_frame_schema, decode_frame
 
 class AccountSerializer(Serializer) :
     
@@ -14,7 +13,8 @@ class AccountSerializer(Serializer) :
         obj_dict["name"] = data.name
         obj_dict["start_value"] = data.start_value
         obj_dict["end_value"] = data.end_value
-        obj_dict["transactions"] = data.transactions.to_dicts()
+        obj_dict["transactions"] = encode_frame(data.transactions)
+        obj_dict["transactions_schema"] = encode_frame_schema(data.transactions)
         return json_dumps(obj_dict, indent=2).encode("utf-8-sig")
 
     def loads(self, blob: bytes) -> typing.Any:
@@ -24,5 +24,8 @@ class AccountSerializer(Serializer) :
         new_accout.name = reader["name"]
         new_accout.start_value = reader["start_value"]
         new_accout.end_value = reader["end_value"]
-        new_accout.transactions = from_dicts(reader["transactions"])
+        if "transactions_schema" in reader :
+            new_accout.transactions = decode_frame(reader["transactions"], reader["transactions_schema"])
+        else :
+            new_accout.transactions = decode_frame(reader["transactions"])
         return new_accout
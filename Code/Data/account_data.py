@@ -1,28 +1,74 @@
 import typing
 from polars import DataFrame, from_dicts
+from polars import String, Struct, Float64, Float32, Int64, Int32, UInt64, UInt32, Boolean
 from Code.Utils.json_serializer import json_serializer
-from polars import DataFrame
+from Code.Data.account_hashing import id_dtype, ids_to_hex, ids_from_hex
 
 derived_transaction_columns = ["date", "delta", "description", "timestamp", "source_ID", "source_account"]
 unidentified_transaction_columns = ["date", "delta", "description", "timestamp"]
 transaction_columns = ["ID", "date", "delta", "description", "timestamp"]
+derived_account_columns = transaction_columns + ["source_ID", "source_account"]
 ledger_columns = ["from_account_name", "from_transaction_id", "to_account_name", "to_transaction_id", "delta"]
+transaction_id_columns = ["ID", "source_ID", "from_transaction_id", "to_transaction_id"]
+
+def encode_transaction_ids(frame : DataFrame) -> DataFrame :
+    return frame.with_columns([ids_to_hex(frame[name]) for name in transaction_id_columns if name in frame.columns and frame[name].dtype == id_dtype])
+
+def decode_transaction_ids(frame : DataFrame) -> DataFrame :
+    #hex strings are both the json encoding and the legacy in-memory IDs, so older stored frames decode the same way
+    decoded_columns = []
+    for name in transaction_id_columns :
+        if name in frame.columns :
+            if frame[name].dtype == String :
+                decoded_columns.append(ids_from_hex(frame[name]))
+            elif isinstance(frame[name].dtype, Struct) and frame[name].dtype != id_dtype :
+                decoded_columns.append(frame[name].cast(id_dtype))
+    return frame.with_columns(decoded_columns)
+
+#json sorts the keys of every row, so column order and types are stored next to the rows
+json_column_types = {str(column_type) : column_type for column_type in [String, Float64, Float32, Int64, Int32, UInt64, UInt32, Boolean]}
+
+def encode_frame(frame : DataFrame) -> typing.List[typing.Dict[str, typing.Any]] :
+    return encode_transaction_ids(frame).to_dicts()
+
+def encode_frame_schema(frame : DataFrame) -> typing.List[typing.List[str]] :
+    #IDs are written as hex strings
+    return [[name, str(String if name in transaction_id_columns and column_type == id_dtype else column_type)] for name, column_type in frame.schema.items()]
+
+def decode_frame(rows : typing.List[typing.Dict[str, typing.Any]], schema : typing.List[typing.List[str]] | None = None) -> DataFrame :
+    if schema is None :
+        #written before the schema was stored, columns come back in key order
+        if len(rows) == 0 :
+            return DataFrame()
+        return decode_transaction_ids(from_dicts(rows))
+    column_types = {name : json_column_types[type_name] for name, type_name in schema if type_name in json_column_types}
+    if len(rows) == 0 :
+        frame = DataFrame(schema={name : column_types.get(name, String) for name, _ in schema})
+    else :
+        frame = from_dicts(rows, schema_overrides=column_types).select([name for name, _ in schema])
+    return decode_transaction_ids(frame)
 
 class DataFrameObject :
 
+    frame_attribute = "frame"
+
     def __init__(self, frame : DataFrame = DataFrame()) :
         self.frame : DataFrame = frame
 
     @staticmethod
     def decode(reader) :
         read_object = DataFrameObject()
-        read_object.frame = from_dicts(reader["frame"])
+        if "frame_schema" in reader :
+            read_object.frame = decode_frame(reader["frame"], reader["frame_schema"])
+        else :
+            read_object.frame = decode_frame(reader["frame"])
         return read_object
     
     @staticmethod
     def encode(obj) :
         writer : typing.Dict[str, typing.Any] = {}
-        writer["frame"] = obj.frame.to_dicts()
+        writer["frame"] = encode_frame(obj.frame)
+        writer["frame_schema"] = encode_frame_schema(obj.frame)
         return writer
     
 json_serializer.register_readable(DataFrameObject)
@@ -30,6 +76,8 @@ json_serializer.register_writeable(DataFrameObject)
 
 class Account :
 
+    frame_attribute = "transactions"
+
     def __init__(self, name : str = "DEFAULT_ACCOUNT", start_value : float = 0.0, transactions : DataFrame = DataFrame()) :
         self.name : str = name
         self.start_value : float = start_value
@@ -45,7 +93,10 @@ class Account :
         new_accout.name = reader["name"]
         new_accout.start_value = reader["start_value"]
         new_accout.end_value = reader["end_value"]
-        new_accout.transactions = from_dicts(reader["transactions"])
+        if "transactions_schema" in reader :
+            new_accout.transactions = decode_frame(reader["transactions"], reader["transactions_schema"])
+        else :
+            new_accout.transactions = decode_frame(reader["transactions"])
         return new_accout
     
     @staticmethod
@@ -54,7 +105,8 @@ class Account :
         writer["name"] = obj.name
         writer["start_value"] = obj.start_value
         writer["end_value"] = obj.end_value
-        writer["transactions"] = obj.transactions.to_dicts()
+        writer["transactions"] = encode_frame(obj.transactions)
+        writer["transactions_schema"] = encode_frame_schema(obj.transactions)
         return writer
     
 json_serializer.register_readable(Account)
@@ -115,6 +167,8 @@ class InternalTransactionMapping :
         self.from_match_strings : typing.List[str] = []
         self.to_account = "<INVALID ACCOUNT>"
         self.to_match_strings : typing.List[str] = []
+        #days a transfer may take to show up on the other account
+        self.date_window : int = 3
 
     @staticmethod
     def decode(reader) :
@@ -123,6 +177,10 @@ class InternalTransactionMapping :
         new_transaction_mapping.from_match_strings = reader["from matchings"]
         new_transaction_mapping.to_account = reader["to account"]
         new_transaction_mapping.to_match_strings = reader["to matchings"]
+        if "date window" in reader :
+            new_transaction_mapping.date_window = reader["date window"]
+        else :
+            new_transaction_mapping.date_window = 3
         return new_transaction_mapping
     
     @staticmethod
@@ -132,8 +190,11 @@ class InternalTransactionMapping :
         writer["from matchings"] = obj.from_match_strings
         writer["to account"] = obj.to_account
         writer["to matchings"] = obj.to_match_strings
+        writer["date window"] = obj.date_window
         return writer
 
+json_serializer.register_writeable(InternalTransactionMapping)
+
 class AccountImport :
 
     def __init__(self) :
@@ -150,6 +211,105 @@ class AccountImport :
             new_account_import.opening_balance = 0.0
         return new_account_import
     
+class ImportManifest :
+
+    class ImportedFile :
+
+        def __init__(self, fingerprint : str, row_count : int) :
+            self.fingerprint : str = fingerprint
+            self.row_count : int = row_count
+
+        @staticmethod
+        def decode(reader) :
+            if "rows" in reader :
+                row_count = reader["rows"]
+            else :
+                row_count = len(reader["ids"])
+            return ImportManifest.ImportedFile(reader["fingerprint"], row_count)
+
+        @staticmethod
+        def encode(obj) :
+            writer : typing.Dict[str, typing.Any] = {}
+            writer["fingerprint"] = obj.fingerprint
+            writer["rows"] = obj.row_count
+            return writer
+
+    #which import files a stored source account was read from and how many rows each gave, so new files can be appended
+    def __init__(self) :
+        self.import_hash : str = "0"
+        self.next_index : int = 0
+        self.files : typing.Dict[str, ImportManifest.ImportedFile] = {}
+
+    @staticmethod
+    def decode(reader) :
+        new_import_manifest = ImportManifest()
+        new_import_manifest.import_hash = reader["import hash"]
+        new_import_manifest.next_index = reader["next index"]
+        new_import_manifest.files = {name : ImportManifest.ImportedFile.decode(f) for name, f in reader["files"].items()}
+        return new_import_manifest
+
+    @staticmethod
+    def encode(obj) :
+        writer : typing.Dict[str, typing.Any] = {}
+        writer["import hash"] = obj.import_hash
+        writer["next index"] = obj.next_index
+        writer["files"] = {name : ImportManifest.ImportedFile.encode(f) for name, f in obj.files.items()}
+        return writer
+
+json_serializer.register_readable(ImportManifest)
+json_serializer.register_writeable(ImportManifest)
+
+class DerivationManifest :
+
+    class SourceFiles :
+
+        def __init__(self, import_hash : str = "0", fingerprints : typing.Dict[str, str] = {}) :
+            self.import_hash : str = import_hash
+            self.fingerprints : typing.Dict[str, str] = dict(fingerprints)
+
+        @staticmethod
+        def decode(reader) :
+            return DerivationManifest.SourceFiles(reader["import hash"], reader["fingerprints"])
+
+        @staticmethod
+        def encode(obj) :
+            writer : typing.Dict[str, typing.Any] = {}
+            writer["import hash"] = obj.import_hash
+            writer["fingerprints"] = obj.fingerprints
+            return writer
+
+    #which import files of each source account a stored derived account was matched against, so rows of new files can be appended
+    def __init__(self) :
+        self.derivation_hash : str = "0"
+        self.next_index : int = 0
+        self.sources : typing.Dict[str, DerivationManifest.SourceFiles] = {}
+        #rows fingerprint of the derived account, hex, "0" if not recorded
+        self.fingerprint : str = "0"
+
+    @staticmethod
+    def decode(reader) :
+        new_derivation_manifest = DerivationManifest()
+        new_derivation_manifest.derivation_hash = reader["derivation hash"]
+        new_derivation_manifest.next_index = reader["next index"]
+        new_derivation_manifest.sources = {name : DerivationManifest.SourceFiles.decode(s) for name, s in reader["sources"].items()}
+        if "fingerprint" in reader :
+            new_derivation_manifest.fingerprint = reader["fingerprint"]
+        else :
+            new_derivation_manifest.fingerprint = "0"
+        return new_derivation_manifest
+
+    @staticmethod
+    def encode(obj) :
+        writer : typing.Dict[str, typing.Any] = {}
+        writer["derivation hash"] = obj.derivation_hash
+        writer["next index"] = obj.next_index
+        writer["sources"] = {name : DerivationManifest.SourceFiles.encode(s) for name, s in obj.sources.items()}
+        writer["fingerprint"] = obj.fingerprint
+        return writer
+
+json_serializer.register_readable(DerivationManifest)
+json_serializer.register_writeable(DerivationManifest)
+
 class LedgerImport :
 
     def __init__(self) :
@@ -157,6 +317,12 @@ class LedgerImport :
         self.accounting_file : str = "<INVALID FILE>"
         self.source_account_folder : str = "INVALID_FOLDER"
         self.raw_accounts : typing.List[AccountImport] = []
+        self.storage_format : str = "json"
+        self.import_workers : int = 0
+        self.import_processes : int = 1
+        self.table_database : str = "config"
+        self.lazy_loading : bool = False
+        self.prefetch : bool = False
 
     @staticmethod
     def decode(reader) :
@@ -165,6 +331,30 @@ class LedgerImport :
         new_ledger_import.accounting_file = reader["accounting file"]
         new_ledger_import.source_account_folder = reader["source account directory"]
         new_ledger_import.raw_accounts = [AccountImport.decode(ra) for ra in reader["source accounts"]]
+        if "storage format" in reader :
+            new_ledger_import.storage_format = reader["storage format"]
+        else :
+            new_ledger_import.storage_format = "json"
+        if "import workers" in reader :
+            new_ledger_import.import_workers = reader["import workers"]
+        else :
+            new_ledger_import.import_workers = 0
+        if "import processes" in reader :
+            new_ledger_import.import_processes = reader["import processes"]
+        else :
+            new_ledger_import.import_processes = 1
+        if "table database" in reader :
+            new_ledger_import.table_database = reader["table database"]
+        else :
+            new_ledger_import.table_database = "config"
+        if "lazy loading" in reader :
+            new_ledger_import.lazy_loading = reader["lazy loading"]
+        else :
+            new_ledger_import.lazy_loading = False
+        if "prefetch" in reader :
+            new_ledger_import.prefetch = reader["prefetch"]
+        else :
+            new_ledger_import.prefetch = False
         return new_ledger_import
 
 class LedgerConfiguration :
@@ -172,12 +362,18 @@ class LedgerConfiguration :
     def __init__(self) :
         self.default_ledger : str = "<INVALID LEDGER>"
         self.ledgers : typing.List[LedgerImport] = []
+        #megabytes of frames open ledgers may keep in memory, 0 for no limit
+        self.ledger_memory_budget : int = 0
 
     @staticmethod
     def decode(reader) :
         new_ledger_config = LedgerConfiguration()
         new_ledger_config.default_ledger = reader["default ledger"]
         new_ledger_config.ledgers = [LedgerImport.decode(ledger) for ledger in reader["ledgers"]]
+        if "ledger memory budget" in reader :
+            new_ledger_config.ledger_memory_budget = reader["ledger memory budget"]
+        else :
+            new_ledger_config.ledger_memory_budget = 0
         return new_ledger_config
 
 json_serializer.register_readable(LedgerConfiguration)
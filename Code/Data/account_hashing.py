@@ -1,8 +1,52 @@
-from xxhash import xxh128
-from polars import Series, DataFrame, concat, String
+import typing
+import numpy
+from pyarrow import Array as ArrowArray, binary, py_buffer
+from xxhash import xxh128, xxh128_digest
+from polars import Series, DataFrame, concat, from_arrow, Binary, Struct, UInt64
 
 from Code.Utils.hashing import hash_float
 
+#transaction IDs are the 128 bit hash as two big endian words, hex only for display and json
+id_word_columns = ["high", "low"]
+id_dtype = Struct({"high" : UInt64, "low" : UInt64})
+id_format_version = 2
+
+def hash_id_format(hasher : typing.Any) -> None :
+    hasher.update(id_format_version.to_bytes(8))
+
+def make_id_series(name : str, id_words : numpy.ndarray) -> Series :
+    id_words = id_words.astype(numpy.uint64)
+    return DataFrame({"high" : id_words[:, 0], "low" : id_words[:, 1]}, schema={"high" : UInt64, "low" : UInt64}).to_struct(name)
+
+def get_id_words(ids : Series) -> DataFrame :
+    return ids.struct.unnest()
+
+def ids_to_bytes(ids : Series) -> Series :
+    #16 big endian bytes, so byte order sorts the same as the hex strings
+    id_words = get_id_words(ids)
+    packed_ids = numpy.stack([id_words["high"].to_numpy(), id_words["low"].to_numpy()], axis=1).astype(">u8")
+    id_bytes = ArrowArray.from_buffers(binary(16), len(ids), [None, py_buffer(packed_ids)])
+    return typing.cast(Series, from_arrow(id_bytes)).cast(Binary).alias(ids.name)
+
+def ids_from_bytes(byte_ids : Series) -> Series :
+    assert byte_ids.null_count() == 0 and (byte_ids.bin.size() == 16).all(), f"Expected 16 byte IDs in column {byte_ids.name}!"
+    arrow_ids = byte_ids.to_arrow()
+    _, offsets_buffer, data_buffer = arrow_ids.buffers()
+    offsets = numpy.frombuffer(offsets_buffer, dtype=numpy.int64)[arrow_ids.offset : arrow_ids.offset + len(arrow_ids) + 1]
+    id_words = numpy.frombuffer(data_buffer, dtype=">u8", count=2 * len(arrow_ids), offset=int(offsets[0]))
+    return make_id_series(byte_ids.name, id_words.reshape(len(arrow_ids), 2))
+
+def ids_to_hex(ids : Series) -> Series :
+    return ids_to_bytes(ids).bin.encode("hex")
+
+def ids_from_hex(hex_ids : Series) -> Series :
+    assert (hex_ids.str.len_bytes() == 32).all(), f"Expected 32 character hex IDs in column {hex_ids.name}!"
+    quarter_words = [hex_ids.str.slice(8 * i, 8).str.to_integer(base=16).cast(UInt64) for i in range(0, 4)]
+    return DataFrame({
+        "high" : quarter_words[0] * (1 << 32) + quarter_words[1],
+        "low" : quarter_words[2] * (1 << 32) + quarter_words[3]
+        }).to_struct(hex_ids.name)
+
 def transaction_hash(index : int, date : str, timestamp : float, delta : float, description : str) -> str :
     hasher = xxh128()
     hasher.update(index.to_bytes(8))
@@ -12,13 +56,97 @@ def transaction_hash(index : int, date : str, timestamp : float, delta : float,
     hasher.update(description.encode())
     return str(hasher.hexdigest())
 
-def make_identified_transaction_dataframe(transactions : DataFrame) -> DataFrame :
+class ByteField :
+
+    #one field of a packed row, either fixed width (lengths is None) or variable width with per row lengths
+    def __init__(self, data : numpy.ndarray, lengths : numpy.ndarray | None = None) :
+        self.data = data
+        self.lengths = lengths
+
+    def get_lengths(self, row_count : int) -> numpy.ndarray :
+        if self.lengths is None :
+            return numpy.full(row_count, self.data.shape[1], dtype=numpy.int64)
+        return self.lengths
+
+def fixed_width_field(values : numpy.ndarray, big_endian_type : str) -> ByteField :
+    return ByteField(values.astype(big_endian_type).view(numpy.uint8).reshape(len(values), -1))
+
+def string_field(strings : Series) -> ByteField :
+    assert strings.null_count() == 0, f"Cannot hash null strings in column {strings.name}!"
+    arrow_strings = strings.to_arrow()
+    _, offsets_buffer, data_buffer = arrow_strings.buffers()
+    offsets = numpy.frombuffer(offsets_buffer, dtype=numpy.int64)[arrow_strings.offset : arrow_strings.offset + len(arrow_strings) + 1]
+    data = numpy.frombuffer(data_buffer, dtype=numpy.uint8)[offsets[0] : offsets[-1]]
+    return ByteField(data, numpy.diff(offsets))
+
+def float_ratio_fields(values : numpy.ndarray) -> typing.List[ByteField] :
+    #columnar float.as_integer_ratio, laid out the same as hash_float
+    assert numpy.isfinite(values).all(), "Cannot hash non-finite float values!"
+    mantissas, exponents = numpy.frexp(values)
+    numerators = numpy.ldexp(mantissas, 53).astype(numpy.int64)
+    exponents = exponents.astype(numpy.int64) - 53
+
+    is_zero = numerators == 0
+    lowest_set_bits = numpy.where(is_zero, 1, numerators & -numerators)
+    trailing_zeros = numpy.log2(lowest_set_bits.astype(numpy.float64)).astype(numpy.int64)
+    numerators = numpy.right_shift(numerators, trailing_zeros)
+    exponents = numpy.where(is_zero, 0, exponents + trailing_zeros)
+
+    is_integral = exponents >= 0
+    bit_lengths = numpy.floor(numpy.log2(numpy.where(is_zero, 1, numpy.abs(numerators)).astype(numpy.float64))).astype(numpy.int64) + 1
+    if numpy.any(is_integral & (bit_lengths + exponents > 63)) or numpy.any(exponents < -63) :
+        raise OverflowError("Float ratio does not fit in 8 bytes!")
+
+    numerators = numpy.left_shift(numerators, numpy.where(is_integral, exponents, 0))
+    denominators = numpy.left_shift(numpy.uint64(1), numpy.where(is_integral, 0, -exponents).astype(numpy.uint64))
+    return [fixed_width_field(numerators, ">i8"), fixed_width_field(denominators, ">u8")]
+
+def pack_rows(fields : typing.List[ByteField], row_count : int) -> typing.Tuple[bytes, numpy.ndarray] :
+    field_lengths = [field.get_lengths(row_count) for field in fields]
+    row_offsets = numpy.zeros(row_count + 1, dtype=numpy.int64)
+    numpy.cumsum(sum(field_lengths), out=row_offsets[1:])
+    row_buffer = numpy.zeros(row_offsets[-1], dtype=numpy.uint8)
+
+    field_starts = row_offsets[:-1].copy()
+    for field, lengths in zip(fields, field_lengths) :
+        if field.lengths is None :
+            row_buffer[field_starts[:, None] + numpy.arange(field.data.shape[1])] = field.data
+        elif field.data.size > 0 :
+            data_starts = numpy.cumsum(lengths) - lengths
+            row_buffer[numpy.repeat(field_starts - data_starts, lengths) + numpy.arange(field.data.size)] = field.data
+        field_starts += lengths
+    return row_buffer.tobytes(), row_offsets
+
+def compatible_transaction_ids(transactions : DataFrame, first_index : int = 0) -> Series :
+    #same bytes per row as transaction_hash, only the xxh128 of each packed row is done per row, in C
+    #the digest words hex back to exactly the transaction_hash string
+    row_count = transactions.height
+    fields = [fixed_width_field(numpy.arange(first_index, first_index + row_count, dtype=numpy.uint64), ">u8"), string_field(transactions["date"])]
+    fields += float_ratio_fields(transactions["timestamp"].to_numpy())
+    fields += float_ratio_fields(transactions["delta"].to_numpy())
+    fields.append(string_field(transactions["description"]))
+    row_buffer, row_offsets = pack_rows(fields, row_count)
+    packed_rows = map(row_buffer.__getitem__, map(slice, row_offsets[:-1].tolist(), row_offsets[1:].tolist()))
+    digests = b"".join(map(xxh128_digest, packed_rows))
+    return make_id_series("ID", numpy.frombuffer(digests, dtype=">u8").reshape(row_count, 2))
+
+def fast_transaction_ids(transactions : DataFrame, first_index : int = 0) -> Series :
+    #polars native row hashing, not the same as transaction_hash and only stable for a given polars version
+    hashed_columns = DataFrame([
+        Series("index", range(first_index, first_index + transactions.height)),
+        transactions["date"],
+        transactions["timestamp"],
+        transactions["delta"],
+        transactions["description"]])
+    high_words = hashed_columns.hash_rows(seed=0x5354, seed_1=0x4f43, seed_2=0x4b45, seed_3=0x4455).to_numpy()
+    low_words = hashed_columns.hash_rows(seed=0x5055, seed_1=0x5044, seed_2=0x4154, seed_3=0x4121).to_numpy()
+    return make_id_series("ID", numpy.stack([high_words, low_words], axis=1))
+
+def make_identified_transaction_dataframe(transactions : DataFrame, compatible : bool = True, first_index : int = 0) -> DataFrame :
+    #first_index lets appended transactions continue the index of an already identified account
     if len(transactions) > 0 :
-        index = DataFrame(Series("TempIndex", range(0, transactions.height)))
-        indexed_transactions = concat([index, transactions], how="horizontal")
-        make_id = lambda t : transaction_hash(int(t[0]), t[1], t[4], t[2], t[3])
-        id_frame = indexed_transactions.map_rows(make_id, String)
-        id_frame.columns = ["ID"]
+        make_ids = compatible_transaction_ids if compatible else fast_transaction_ids
+        id_frame = DataFrame(make_ids(transactions, first_index))
     else :
-        id_frame = DataFrame(schema={"ID" : String})
-    return concat([id_frame, transactions], how="horizontal")
\ No newline at end of file
+        id_frame = DataFrame(schema={"ID" : id_dtype})
+    return concat([id_frame, transactions], how="horizontal")
@@ -9,15 +9,10 @@ from Code.Utils.logger import get_logger
 logger = get_logger(__name__)
 
 from Code.source_database import SourceDataBase
-from Code.Data.account_data import Account, transaction_columns, DerivedAccount, InternalTransactionMapping
-from Code.Data.account_hashing import make_identified_transaction_dataframe
+from Code.Data.account_data import Account, transaction_columns, derived_account_columns, DerivedAccount, DerivationManifest
+from Code.Data.account_hashing import make_identified_transaction_dataframe, hash_id_format, id_word_columns
 from Code.Utils.hashing import hash_source, hash_object
-
-def escape_string(string : str) -> str :
-    return string.replace("*", "\*").replace("+", "\+").replace("(", "\(").replace(")", "\)")
-
-def strings_to_regex(strings : typing.List[str]) -> str :
-    return "|".join([escape_string(s) for s in strings])
+from Code.Pipeline.transaction_classification import TransactionClassifier, get_matched_transactions
 
 def derive_transaction_dataframe(account_name : str, dataframe : DataFrame) -> DataFrame :
     return DataFrame({
@@ -29,16 +24,8 @@ def derive_transaction_dataframe(account_name : str, dataframe : DataFrame) -> D
         "source_account" : repeat(account_name, dataframe.height)
     })
 
-def get_matched_transactions(match_account : Account, string_matches : typing.List[str]) -> DataFrame :
-    account_name = match_account.name
-    assert match_account is not None, f"Account not found! Expected account \"{account_name}\" to exist!"
-    logger.info(f"Checking account {account_name} with {len(match_account.transactions)} transactions")
-    
-    regex = strings_to_regex(string_matches)
-    matched_transactions = match_account.transactions.filter(col("description").str.contains(regex))
-
-    logger.info(f"Found {matched_transactions.height} transactions in {account_name}")
-    return matched_transactions
+def get_matcher(classifier : TransactionClassifier | None) -> typing.Callable[[Account, typing.List[str]], DataFrame] :
+    return get_matched_transactions if classifier is None else classifier.get_matched_transactions
 
 def is_universal_matching(account_derivation : DerivedAccount) -> bool :
     return len(account_derivation.matchings) == 1 and account_derivation.matchings[0] is not None and account_derivation.matchings[0].account_name == ""
@@ -47,11 +34,12 @@ def create_derived_account_key(source_accounts, account_derivation, task_source_
     hasher = xxh128()
     hash_object(hasher, account_derivation)
     if is_universal_matching(account_derivation) :
-        for account in source_accounts.get_names() :
-            hasher.update(source_accounts.get_account_hash(account))
+        for account in source_accounts.get_account_names() :
+            hasher.update(source_accounts.get_account_fingerprint(account))
     else :
         for matching in account_derivation.matchings :
-            hasher.update(source_accounts.get_account_hash(matching.account_name))
+            hasher.update(source_accounts.get_account_fingerprint(matching.account_name))
+    hash_id_format(hasher)
     hash_source(hasher, task_source_object)
     return hasher.hexdigest()
 
@@ -61,55 +49,132 @@ def create_derived_account_key_wrapper(run_context, parameters) :
         parameters["account_derivation"], 
         run_context.task)
 
-def get_derived_transactions_from_all_source(source_accounts : SourceDataBase, account_derivation : DerivedAccount) -> DataFrame :
+def get_derived_transactions_from_all_source(source_accounts : SourceDataBase, account_derivation : DerivedAccount, classifier : TransactionClassifier | None = None) -> DataFrame :
     universal_match_strings = account_derivation.matchings[0].strings
     logger.info(f"Checking all base accounts for {universal_match_strings}")
     matched_transaction_frames = []
-    for account_name in source_accounts.get_names() :
-        found_tuples = get_matched_transactions(source_accounts.get_account(account_name), universal_match_strings)
+    for account_name in source_accounts.get_account_names() :
+        found_tuples = get_matcher(classifier)(source_accounts.get_account(account_name), universal_match_strings)
         matched_transaction_frames.append(derive_transaction_dataframe(account_name, found_tuples))
     return concat(matched_transaction_frames)
 
-def get_derived_transactions_from_matchings(source_accounts : SourceDataBase, account_derivation : DerivedAccount) -> DataFrame :
+def get_derived_transactions_from_matchings(source_accounts : SourceDataBase, account_derivation : DerivedAccount, classifier : TransactionClassifier | None = None) -> DataFrame :
     matched_transaction_frames = []
     for matching in account_derivation.matchings :
         if matching.account_name == "" :
             raise RuntimeError(f"Nonspecific match strings detected for account {account_derivation.name}! Not compatible with specified accounts!")
         logger.info(f"Checking {matching.account_name} account for {matching.strings}")
-        found_tuples = get_matched_transactions(source_accounts.get_account(matching.account_name), matching.strings)
+        found_tuples = get_matcher(classifier)(source_accounts.get_account(matching.account_name), matching.strings)
         matched_transaction_frames.append(derive_transaction_dataframe(matching.account_name, found_tuples))
     return concat(matched_transaction_frames)
 
 @task(cache_key_fn=create_derived_account_key_wrapper)
-def get_derived_matched_transactions(source_accounts : SourceDataBase, account_derivation : DerivedAccount) -> DataFrame :
+def get_derived_matched_transactions(source_accounts : SourceDataBase, account_derivation : DerivedAccount, classifier : TransactionClassifier | None = None) -> DataFrame :
     if is_universal_matching(account_derivation) :
-        all_matched_transactions = get_derived_transactions_from_all_source(source_accounts, account_derivation)    
+        all_matched_transactions = get_derived_transactions_from_all_source(source_accounts, account_derivation, classifier)    
     else :
-        all_matched_transactions = get_derived_transactions_from_matchings(source_accounts, account_derivation)
+        all_matched_transactions = get_derived_transactions_from_matchings(source_accounts, account_derivation, classifier)
     assert account_derivation.name not in all_matched_transactions["source_account"].unique(), "Transaction to same account forbidden!"
     all_matched_transactions = all_matched_transactions.sort(by="timestamp", maintain_order=True)
     return make_identified_transaction_dataframe(all_matched_transactions)
 
-@task(cache_key_fn=create_derived_account_key_wrapper)
-def create_derived_matching_ledger_entries(source_accounts : SourceDataBase, account_derivation : DerivedAccount) -> DataFrame :
-    derived_transactions = get_derived_matched_transactions(source_accounts, account_derivation)
+def create_derived_matching_ledger_entries(derived_account : Account) -> DataFrame :
+    #entries come from the stored derived account, its IDs depend on the order rows were appended in
+    derived_transactions = derived_account.transactions
     return DataFrame({
         "from_account_name" : derived_transactions["source_account"],
         "from_transaction_id" : derived_transactions["source_ID"],
-        "to_account_name" : Series(values=repeat(account_derivation.name, derived_transactions.height), dtype=String),
+        "to_account_name" : Series(values=repeat(derived_account.name, derived_transactions.height), dtype=String),
         "to_transaction_id" : derived_transactions["ID"],
         "delta" : derived_transactions["delta"].abs()
     })
 
 @task(cache_key_fn=create_derived_account_key_wrapper)
-def create_derived_account(source_accounts : SourceDataBase, account_derivation : DerivedAccount) -> Account :
-    derived_transactions = get_derived_matched_transactions(source_accounts, account_derivation)
-    account = Account(account_derivation.name, account_derivation.start_value, derived_transactions[transaction_columns])
+def create_derived_account(source_accounts : SourceDataBase, account_derivation : DerivedAccount, classifier : TransactionClassifier | None = None) -> Account :
+    derived_transactions = get_derived_matched_transactions(source_accounts, account_derivation, classifier)
+    account = Account(account_derivation.name, account_derivation.start_value, derived_transactions[derived_account_columns])
     return account
 
 def get_derived_account_hash(source_accounts : SourceDataBase, account_derivation : DerivedAccount) -> str :
     return create_derived_account_key(source_accounts, account_derivation, create_derived_account)
 
 @flow
-def get_derived_account(source_accounts : SourceDataBase, account_derivation : DerivedAccount) -> Account :
-    return create_derived_account(source_accounts, account_derivation)
+def get_derived_account(source_accounts : SourceDataBase, account_derivation : DerivedAccount, classifier : TransactionClassifier | None = None) -> Account :
+    return create_derived_account(source_accounts, account_derivation, classifier)
+
+def get_derivation_source_names(source_accounts : SourceDataBase, account_derivation : DerivedAccount) -> typing.List[str] :
+    if is_universal_matching(account_derivation) :
+        return source_accounts.get_account_names()
+    return list(dict.fromkeys([matching.account_name for matching in account_derivation.matchings]))
+
+def get_derivation_hash(account_derivation : DerivedAccount) -> str :
+    hasher = xxh128()
+    hash_object(hasher, account_derivation)
+    hash_id_format(hasher)
+    hash_source(hasher, derive_transaction_dataframe)
+    hash_source(hasher, update_derived_account)
+    return hasher.hexdigest()
+
+def is_derivation_manifest_valid(manifest : DerivationManifest, derivation_hash : str, source_files : typing.Dict[str, DerivationManifest.SourceFiles], stored_transactions : DataFrame) -> bool :
+    if manifest.derivation_hash != derivation_hash or manifest.sources.keys() != source_files.keys() :
+        return False
+    #rows are only ever appended, so a stored account of any other height missed its last write
+    if stored_transactions.columns != derived_account_columns or stored_transactions.height != manifest.next_index :
+        return False
+    #a changed import script can change rows without touching the files
+    return all(files.import_hash != "0" and manifest.sources[name].import_hash == files.import_hash for name, files in source_files.items())
+
+def get_new_derived_transactions(new_source_accounts : typing.Dict[str, Account], account_derivation : DerivedAccount) -> DataFrame :
+    matched_transaction_frames = []
+    for matching in account_derivation.matchings :
+        match_account_names = list(new_source_accounts.keys()) if matching.account_name == "" else [matching.account_name]
+        for account_name in match_account_names :
+            found_tuples = get_matched_transactions(new_source_accounts[account_name], matching.strings)
+            matched_transaction_frames.append(derive_transaction_dataframe(account_name, found_tuples))
+    return concat(matched_transaction_frames).sort(by="timestamp", maintain_order=True)
+
+def update_derived_account(source_accounts : SourceDataBase, account_derivation : DerivedAccount, stored_account : Account | None, manifest : DerivationManifest, classifier : TransactionClassifier | None = None) -> typing.Tuple[Account, DerivationManifest] :
+    account_name = account_derivation.name
+    derivation_hash = get_derivation_hash(account_derivation)
+    source_names = get_derivation_source_names(source_accounts, account_derivation)
+    #sources brought up to date first, so their import manifests describe the rows matched against
+    source_transactions = {name : source_accounts.get_account(name).transactions for name in source_names}
+    import_manifests = {name : source_accounts.get_import_manifest(name) for name in source_names}
+    source_files = {name : DerivationManifest.SourceFiles(m.import_hash, {file_name : f.fingerprint for file_name, f in m.files.items()}) for name, m in import_manifests.items()}
+
+    stored_transactions = DataFrame() if stored_account is None else stored_account.transactions
+    if stored_account is None or not is_derivation_manifest_valid(manifest, derivation_hash, source_files, stored_transactions) :
+        logger.info(f"No valid derivation manifest for {account_name}, deriving all transactions")
+        account = get_derived_account(source_accounts, account_derivation, classifier)
+        manifest = DerivationManifest()
+        manifest.derivation_hash = derivation_hash
+        manifest.next_index = account.transactions.height
+        manifest.sources = source_files
+        return account, manifest
+
+    #only rows of new or changed files are matched, rows already derived from are never matched twice
+    stored_source_words = stored_transactions.select(col("source_account"), col("source_ID").struct.unnest())
+    new_source_accounts = {}
+    for name in source_names :
+        source_words = source_transactions[name].with_columns(col("ID").struct.unnest())
+        stored_words = stored_source_words.filter(col("source_account") == name).select(id_word_columns)
+        if stored_words.join(source_words, on=id_word_columns, how="anti").height > 0 :
+            logger.info(f"Transactions derived from {name} were removed, deriving all transactions of {account_name}")
+            return update_derived_account(source_accounts, account_derivation, None, DerivationManifest(), classifier)
+        #matching goes row by row, so rows checked before and not derived from would not match again either
+        seen_fingerprints = manifest.sources[name].fingerprints
+        new_transactions = source_transactions[name].clear()
+        if any(seen_fingerprints.get(file_name) != imported_file.fingerprint for file_name, imported_file in import_manifests[name].files.items()) :
+            new_transactions = source_words.join(stored_words, on=id_word_columns, how="anti", maintain_order="left").select(transaction_columns)
+        new_source_accounts[name] = Account(name, 0.0, new_transactions)
+
+    manifest.sources = source_files
+    new_source_count = sum(account.transactions.height for account in new_source_accounts.values())
+    if new_source_count == 0 :
+        return Account(account_name, account_derivation.start_value, stored_transactions), manifest
+
+    new_derived_transactions = make_identified_transaction_dataframe(get_new_derived_transactions(new_source_accounts, account_derivation), first_index=manifest.next_index)
+    manifest.next_index += new_derived_transactions.height
+    merged_transactions = concat([stored_transactions, new_derived_transactions.select(derived_account_columns)]).sort(by="timestamp", maintain_order=True)
+    logger.info(f"Matched {new_source_count} source transactions not derived from, appended {new_derived_transactions.height} to {account_name}")
+    return Account(account_name, account_derivation.start_value, merged_transactions), manifest
@@ -1,14 +1,16 @@
 import typing
+from os import cpu_count
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from polars import Series, DataFrame
-from polars import when, concat
-from polars import String, Float64
+from polars import when, concat, col
+from polars import String, Float64, UInt32
 from prefect import flow, task
 
 from Code.Data import AccountSerializer
-from Code.Data.account_data import unidentified_transaction_columns, transaction_columns, Account, AccountImport
-from Code.Data.account_hashing import make_identified_transaction_dataframe
-from Code.Utils.hashing import hash_path, hash_float, hash_source, hash_string
+from Code.Data.account_data import unidentified_transaction_columns, transaction_columns, Account, AccountImport, ImportManifest
+from Code.Data.account_hashing import make_identified_transaction_dataframe, hash_id_format, id_dtype
+from Code.Utils.hashing import hash_path, hash_file, hash_float, hash_source, hash_string
 
 from xxhash import xxh128
 
@@ -71,17 +73,33 @@ def homogenize_transactions(df : DataFrame) -> DataFrame :
         "timestamp" : df["TransDate"].dt.epoch(time_unit="s").cast(Float64)
         })
 
-def read_transactions_from_csv(input_file_path : Path) -> DataFrame :
+def read_transactions_from_csv(input_file_path : Path, import_dataframe : typing.Callable | None = None) -> DataFrame :
     result = DataFrame()
     if input_file_path.is_file() and input_file_path.suffix == ".csv" :
         logger.info(f"Reading in {input_file_path}")
-        import_dataframe = get_import_function(input_file_path.parent)
+        if import_dataframe is None :
+            import_dataframe = get_import_function(input_file_path.parent)
         imported_csv = import_dataframe(input_file_path)
         result = homogenize_transactions(imported_csv)
     return result
 
-def read_transactions_from_csv_in_path(input_folder_path : Path) -> DataFrame :
-    assert input_folder_path.is_dir(), f"invalid directory {input_folder_path}"
+def get_import_worker_count(import_workers : int, file_count : int) -> int :
+    #0 means one worker per core
+    if import_workers <= 0 :
+        import_workers = cpu_count() or 1
+    return max(1, min(import_workers, file_count))
+
+def read_transactions_from_csv_files(input_folder_path : Path, file_paths : typing.List[Path], import_workers : int = 0) -> typing.List[DataFrame] :
+    #polars releases the GIL while parsing, so threads are enough, results come back in file_paths order
+    import_dataframe = get_import_function(input_folder_path)
+    read_file = lambda file_path : read_transactions_from_csv(file_path, import_dataframe)
+    worker_count = get_import_worker_count(import_workers, len(file_paths))
+    if worker_count == 1 :
+        return list(map(read_file, file_paths))
+    with ThreadPoolExecutor(max_workers=worker_count) as executor :
+        return list(executor.map(read_file, file_paths))
+
+def make_empty_transaction_frame() -> DataFrame :
     empty_frame = DataFrame(schema={
             "date" : String,
             "delta" : Float64,
@@ -89,15 +107,22 @@ def read_transactions_from_csv_in_path(input_folder_path : Path) -> DataFrame :
             "timestamp" : Float64
             })
     assert empty_frame.columns == unidentified_transaction_columns
-    data_frame_list = [empty_frame]
+    return empty_frame
+
+def get_csv_file_paths(input_folder_path : Path) -> typing.List[Path] :
+    #sorted so equal timestamps always land in the same order, which keeps IDs reproducible
+    return sorted(file_path for file_path in input_folder_path.iterdir() if file_path.is_file() and file_path.suffix == ".csv")
+
+def read_transactions_from_csv_in_path(input_folder_path : Path, import_workers : int = 0) -> DataFrame :
+    assert input_folder_path.is_dir(), f"invalid directory {input_folder_path}"
+    data_frame_list = [make_empty_transaction_frame()]
     
-    for file_path in input_folder_path.iterdir() :
-        homogenized_df = read_transactions_from_csv(file_path)
+    for homogenized_df in read_transactions_from_csv_files(input_folder_path, get_csv_file_paths(input_folder_path), import_workers) :
         if homogenized_df.columns == unidentified_transaction_columns :
             data_frame_list.append(homogenized_df)
 
     read_transactions = concat(data_frame_list)
-    read_transactions = read_transactions.sort(by="timestamp")
+    read_transactions = read_transactions.sort(by="timestamp", maintain_order=True)
     return read_transactions
 
 def import_raw_account_key(account_name, raw_account_path, start_balance, task_source_object) :
@@ -120,19 +145,101 @@ def import_raw_account_key_wrapper(run_context, parameters) :
         cache_key_fn=import_raw_account_key_wrapper, 
         result_serializer=AccountSerializer()
         )
-def import_raw_account(account_name : str, raw_account_path : Path, start_balance : float) -> Account :
-    read_transactions = read_transactions_from_csv_in_path(raw_account_path)
+def import_raw_account(account_name : str, raw_account_path : Path, start_balance : float, import_workers : int = 0) -> Account :
+    read_transactions = read_transactions_from_csv_in_path(raw_account_path, import_workers)
     read_transactions = make_identified_transaction_dataframe(read_transactions)
     assert read_transactions.columns == transaction_columns
     account = Account(account_name, start_balance, read_transactions)
     return account
 
+def get_file_fingerprint(file_path : Path) -> str :
+    hasher = xxh128()
+    hash_file(hasher, file_path)
+    return hasher.hexdigest()
+
+def get_import_hash(raw_account_path : Path) -> str :
+    #anything that changes how rows are read or identified invalidates every imported file
+    hasher = xxh128()
+    hash_id_format(hasher)
+    import_script = raw_account_path / "import_dataframe.py"
+    if import_script.is_file() :
+        hash_file(hasher, import_script)
+    hash_source(hasher, read_transactions_from_csv)
+    hash_source(hasher, homogenize_transactions)
+    hash_source(hasher, get_delta_values)
+    hash_source(hasher, update_imported_account)
+    return hasher.hexdigest()
+
+def is_manifest_valid(manifest : ImportManifest, import_hash : str, stored_transactions : DataFrame) -> bool :
+    if manifest.import_hash != import_hash :
+        return False
+    #every row was read from one file and new IDs continue from the next index
+    manifest_row_count = sum(imported_file.row_count for imported_file in manifest.files.values())
+    return manifest_row_count == stored_transactions.height and stored_transactions.height <= manifest.next_index
+
+def with_occurrence(transactions : DataFrame) -> DataFrame :
+    #numbers identical rows so duplicates pair up one to one
+    return transactions.with_columns(col("timestamp").cum_count().over(unidentified_transaction_columns).cast(UInt32).alias("occurrence"))
+
+def update_imported_account(account_name : str, raw_account_path : Path, start_balance : float, stored_account : Account | None, manifest : ImportManifest, import_workers : int = 0) -> typing.Tuple[Account, ImportManifest] :
+    assert raw_account_path.is_dir(), f"invalid directory {raw_account_path}"
+    import_hash = get_import_hash(raw_account_path)
+    stored_transactions = DataFrame(schema={"ID" : id_dtype}).hstack(make_empty_transaction_frame())
+    if stored_account is not None and stored_account.transactions.height > 0 :
+        stored_transactions = stored_account.transactions
+    if stored_account is None or not is_manifest_valid(manifest, import_hash, stored_transactions) :
+        logger.info(f"No valid import manifest for {account_name}, importing all files")
+        stored_transactions = stored_transactions.clear()
+        manifest = ImportManifest()
+        manifest.import_hash = import_hash
+
+    file_fingerprints = {file_path.name : get_file_fingerprint(file_path) for file_path in get_csv_file_paths(raw_account_path)}
+    changed_names = [name for name, fingerprint in file_fingerprints.items() if name not in manifest.files or manifest.files[name].fingerprint != fingerprint]
+    stale_names = [name for name in manifest.files if name not in file_fingerprints or name in changed_names]
+    if len(changed_names) == 0 and len(stale_names) == 0 :
+        return Account(account_name, start_balance, stored_transactions), manifest
+
+    #new files are appended, a changed or removed file has every file read again, identical rows read back in keep their IDs
+    kept_transactions = stored_transactions
+    stale_transactions = with_occurrence(stored_transactions.clear())
+    if len(stale_names) > 0 :
+        changed_names = list(file_fingerprints.keys())
+        stale_names = list(manifest.files.keys())
+        kept_transactions = stored_transactions.clear()
+        stale_transactions = with_occurrence(stored_transactions)
+
+    data_frame_list = [make_empty_transaction_frame().with_columns(Series("file", [], String))]
+    read_frames = read_transactions_from_csv_files(raw_account_path, [raw_account_path / name for name in changed_names], import_workers)
+    for name, homogenized_df in zip(changed_names, read_frames) :
+        if homogenized_df.columns == unidentified_transaction_columns :
+            data_frame_list.append(homogenized_df.with_columns(Series("file", [name] * homogenized_df.height, String)))
+    read_transactions = with_occurrence(concat(data_frame_list).sort(by="timestamp", maintain_order=True))
+
+    read_transactions = read_transactions.join(stale_transactions, on=unidentified_transaction_columns + ["occurrence"], how="left", maintain_order="left")
+    reidentified_transactions = read_transactions.filter(col("ID").is_not_null())
+    new_transactions = read_transactions.filter(col("ID").is_null()).drop("ID")
+    new_transactions = make_identified_transaction_dataframe(new_transactions.select(unidentified_transaction_columns), first_index=manifest.next_index).with_columns(new_transactions["file"])
+    read_transactions = concat([reidentified_transactions.select(transaction_columns + ["file"]), new_transactions])
+    logger.info(f"Imported {len(changed_names)} files into {account_name}, {new_transactions.height} new, {reidentified_transactions.height} kept and {stale_transactions.height - reidentified_transactions.height} removed transactions")
+
+    for name in stale_names :
+        del manifest.files[name]
+    file_rows = read_transactions.group_by("file").len()
+    read_file_rows = dict(zip(file_rows["file"].to_list(), file_rows["len"].to_list()))
+    for name in changed_names :
+        manifest.files[name] = ImportManifest.ImportedFile(file_fingerprints[name], read_file_rows.get(name, 0))
+    manifest.next_index += new_transactions.height
+
+    merged_transactions = concat([kept_transactions, read_transactions.select(transaction_columns)]).sort(by="timestamp", maintain_order=True)
+    assert merged_transactions.columns == transaction_columns
+    return Account(account_name, start_balance, merged_transactions), manifest
+
 def get_imported_account_hash(account_data_path : Path, account_import : AccountImport) -> str :
     raw_account_path = account_data_path / account_import.account_name
-    return import_raw_account_key(account_import.account_name, raw_account_path, account_import.opening_balance, import_raw_account)
+    return import_raw_account_key(account_import.account_name, raw_account_path, account_import.opening_balance, update_imported_account)
 
 @flow
-def get_imported_account(account_data_path : Path, account_import : AccountImport) -> Account :
+def get_imported_account(account_data_path : Path, account_import : AccountImport, import_workers : int = 0) -> Account :
     raw_account_path = account_data_path / account_import.account_name
-    account = import_raw_account(account_import.account_name, raw_account_path, account_import.opening_balance)
+    account = import_raw_account(account_import.account_name, raw_account_path, account_import.opening_balance, import_workers)
     return account
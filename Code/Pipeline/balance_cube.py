@@ -0,0 +1,78 @@
+import typing
+import numpy
+from polars import DataFrame, Series, Float64, Int64
+from polars import concat, col, lit
+
+from Code.Utils.logger import get_logger
+logger = get_logger(__name__)
+
+from Code.Data.account_data import Account
+from Code.Pipeline.transaction_classification import TransactionClassifier
+
+seconds_per_day = 24 * 60 * 60
+#kept apart from account names, which are the other columns
+day_column = "__day"
+
+def get_day(timestamp : float) -> int :
+    return int(timestamp // seconds_per_day)
+
+def make_empty_balance_cube(account_names : typing.List[str], start_values : typing.List[float]) -> DataFrame :
+    columns = {day_column : Series(day_column, [0], Int64)}
+    for account_name, start_value in zip(account_names, start_values) :
+        columns[account_name] = Series(account_name, [start_value], Float64)
+    return DataFrame(columns)
+
+def build_balance_cube(account_names : typing.List[str], inputs : typing.List[Account], classifier : TransactionClassifier | None = None) -> DataFrame :
+    #one row per day, one column per account of its balance at the end of that day
+    #the first row is the day before any transaction and holds the start values
+    start_values = [account.start_value for account in inputs]
+    day_frames = []
+    for account_index, account in enumerate(inputs) :
+        if account.transactions.height > 0 :
+            day_frames.append(account.transactions.select([
+                (col("timestamp") // seconds_per_day).cast(Int64).alias(day_column),
+                col("delta").cast(Float64),
+                lit(account_index, Int64).alias("account_index")]))
+    if len(day_frames) == 0 :
+        return make_empty_balance_cube(account_names, start_values)
+
+    day_deltas = concat(day_frames).group_by(["account_index", day_column]).agg(col("delta").sum())
+    days = day_deltas[day_column].to_numpy()
+    first_day = int(days.min()) - 1
+    day_count = int(days.max()) - first_day + 1
+    deltas = numpy.zeros((len(account_names), day_count))
+    deltas[day_deltas["account_index"].to_numpy(), days - first_day] = day_deltas["delta"].to_numpy()
+    balances = numpy.asarray(start_values, dtype=numpy.float64)[:, None] + numpy.cumsum(deltas, axis=1)
+    logger.info(f"Built balance cube of {len(account_names)} accounts over {day_count} days")
+
+    columns = [Series(day_column, numpy.arange(first_day, first_day + day_count), Int64)]
+    columns += [Series(account_name, balances[account_index], Float64) for account_index, account_name in enumerate(account_names)]
+    return DataFrame(columns)
+
+class BalanceCube :
+
+    #accounts by days, each account row contiguous, so any set of accounts over any days is a sum of row slices
+    def __init__(self, cube_frame : DataFrame) :
+        account_names = [column for column in cube_frame.columns if column != day_column]
+        self.__account_index : typing.Dict[str, int] = {account_name : index for index, account_name in enumerate(account_names)}
+        self.__first_day : int = int(cube_frame[day_column][0])
+        self.__day_count : int = cube_frame.height
+        if len(account_names) > 0 :
+            self.__balances = numpy.ascontiguousarray(cube_frame.select(account_names).to_numpy().T)
+        else :
+            self.__balances = numpy.zeros((0, self.__day_count))
+
+    def get_account_names(self) -> typing.List[str] :
+        return list(self.__account_index.keys())
+
+    def get_balances(self, account_names : typing.List[str], start_timestamp : float, end_timestamp : float) -> DataFrame :
+        #total balance at the end of every day in the range, days outside the cube hold its first or last balances
+        rows = [self.__account_index[account_name] for account_name in account_names if account_name in self.__account_index]
+        days = numpy.arange(get_day(start_timestamp), get_day(end_timestamp) + 1)
+        day_rows = numpy.clip(days - self.__first_day, 0, self.__day_count - 1)
+        if len(day_rows) == 0 :
+            totals = numpy.zeros(0)
+        else :
+            first_row, last_row = day_rows[0], day_rows[-1] + 1
+            totals = self.__balances[rows, first_row:last_row].sum(axis=0)[day_rows - first_row]
+        return DataFrame({"timestamp" : Series("timestamp", days * seconds_per_day, Float64), "balance" : Series("balance", totals, Float64)})
@@ -0,0 +1,98 @@
+import typing
+from xxhash import xxh128
+
+from Code.Utils.logger import get_logger
+logger = get_logger(__name__)
+
+from Code.Utils.hashing import hash_source, hash_object, hash_string
+from Code.Data.account_hashing import hash_id_format
+
+class BuildNode :
+
+    def __init__(self, name : str, kind : str, inputs : typing.List[str], parameter : typing.Any = None, builder : typing.Callable | None = None, code : typing.List[typing.Any] | None = None) :
+        self.name : str = name
+        self.kind : str = kind
+        self.inputs : typing.List[str] = inputs
+        self.parameter : typing.Any = parameter
+        self.builder : typing.Callable | None = builder
+        #everything whose source changes what the builder produces
+        self.code : typing.List[typing.Any] = ([] if builder is None else [builder]) + ([] if code is None else code)
+
+    def is_leaf(self) -> bool :
+        return self.builder is None
+
+class BuildGraph :
+
+    #a node key depends only on its own parameter, its code and the keys of its inputs, so a change only reaches its dependents
+    #leaves are values held elsewhere, they bring their own key and getter
+    def __init__(self) :
+        self.__nodes : typing.Dict[str, BuildNode] = {}
+        self.__leaf_keys : typing.Dict[str, typing.Callable[[], str]] = {}
+        self.__leaf_values : typing.Dict[str, typing.Callable[[], typing.Any]] = {}
+        self.__keys : typing.Dict[str, str] = {}
+
+    def add_leaf(self, name : str, kind : str, key_getter : typing.Callable[[], str], value_getter : typing.Callable[[], typing.Any]) -> None :
+        assert name not in self.__nodes, f"Build node {name} added twice!"
+        self.__nodes[name] = BuildNode(name, kind, [])
+        self.__leaf_keys[name] = key_getter
+        self.__leaf_values[name] = value_getter
+
+    def add_node(self, name : str, kind : str, inputs : typing.List[str], parameter : typing.Any, builder : typing.Callable, code : typing.List[typing.Any] | None = None) -> None :
+        assert name not in self.__nodes, f"Build node {name} added twice!"
+        for input_name in inputs :
+            assert input_name in self.__nodes, f"Build node {name} needs {input_name}, inputs must be added first!"
+        self.__nodes[name] = BuildNode(name, kind, inputs, parameter, builder, code)
+
+    def has_node(self, name : str) -> bool :
+        return name in self.__nodes
+
+    def get_node(self, name : str) -> BuildNode :
+        return self.__nodes[name]
+
+    def get_names(self, kind : str | None = None) -> typing.List[str] :
+        return [name for name, node in self.__nodes.items() if kind is None or node.kind == kind]
+
+    def get_built_names(self) -> typing.List[str] :
+        return [name for name, node in self.__nodes.items() if not node.is_leaf()]
+
+    def begin_session(self) -> None :
+        #leaf keys are read again, anything changed since is picked up
+        self.__keys.clear()
+
+    def get_key(self, name : str) -> str :
+        if name not in self.__keys :
+            node = self.__nodes[name]
+            if node.is_leaf() :
+                self.__keys[name] = self.__leaf_keys[name]()
+            else :
+                hasher = xxh128()
+                hash_string(hasher, node.kind)
+                hash_string(hasher, node.name)
+                if node.parameter is not None :
+                    hash_object(hasher, node.parameter)
+                for code_object in node.code :
+                    hash_source(hasher, code_object)
+                hash_id_format(hasher)
+                for input_name in node.inputs :
+                    hash_string(hasher, self.get_key(input_name))
+                self.__keys[name] = hasher.hexdigest()
+        return self.__keys[name]
+
+    def get_leaf_value(self, name : str) -> typing.Any :
+        return self.__leaf_values[name]()
+
+    def build(self, name : str, get_value : typing.Callable[[str], typing.Any], *context : typing.Any) -> typing.Any :
+        node = self.__nodes[name]
+        assert not node.is_leaf(), f"Leaf {name} is not built here!"
+        assert node.builder is not None
+        logger.info(f"Building {node.kind} node {name}")
+        return node.builder(node.parameter, [get_value(input_name) for input_name in node.inputs], *context)
+
+    def evaluate(self, name : str, *context : typing.Any) -> typing.Any :
+        #builds without any stored results, each node at most once
+        values : typing.Dict[str, typing.Any] = {}
+        def get_value(node_name : str) -> typing.Any :
+            if node_name not in values :
+                values[node_name] = self.get_leaf_value(node_name) if self.__nodes[node_name].is_leaf() else self.build(node_name, get_value, *context)
+            return values[node_name]
+        return get_value(name)
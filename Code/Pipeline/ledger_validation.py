@@ -1,130 +1,268 @@
 import typing
+import numpy
 from numpy import repeat
-from polars import DataFrame, Series
-from polars import concat
+from polars import DataFrame, LazyFrame, Series, String, Float64, Int64, UInt32, UInt64
+from polars import concat, col, lit
 from prefect import task, flow
-from prefect.cache_policies import TASK_SOURCE, INPUTS
+from prefect.context import TaskRunContext
+from prefect.cache_policies import TASK_SOURCE, INPUTS, CacheKeyFnPolicy
 from xxhash import xxh128
 
 from Code.Utils.logger import get_logger
 logger = get_logger(__name__)
 
 from Code.source_database import SourceDataBase
-from Code.Utils.hashing import hash_source, hash_object
-from Code.Data.account_data import Account, DerivedAccount, InternalTransactionMapping, AccountMapping, ledger_columns
+from Code.derived_database import DerivedDataBase
+from Code.Data.account_data import Account, DerivedAccount, InternalTransactionMapping, AccountMapping, ledger_columns, encode_transaction_ids
+from Code.Data.account_hashing import id_dtype, id_word_columns, get_id_words, hash_id_format
 
-from Code.Pipeline.account_derivation import create_derived_matching_ledger_entries, get_matched_transactions
+from Code.Pipeline.account_derivation import create_derived_matching_ledger_entries, get_matcher, get_derivation_source_names
+from Code.Pipeline.build_graph import BuildGraph
+from Code.Pipeline.transaction_classification import TransactionClassifier
+from Code.Pipeline.balance_cube import build_balance_cube
 
-@task(cache_policy=TASK_SOURCE + INPUTS)
-def create_derived_ledger_entries(account_derivations : typing.List[DerivedAccount], source_accounts : SourceDataBase) -> DataFrame :
-    new_ledger_entries = []
-    for account_derivation in account_derivations :
-        derived_ledger_entries = create_derived_matching_ledger_entries(source_accounts, account_derivation)
-        new_ledger_entries.append(derived_ledger_entries)
-    return concat(new_ledger_entries)
+def id_format_key(run_context : TaskRunContext, parameters : typing.Dict[str, typing.Any]) -> str :
+    hasher = xxh128()
+    hash_id_format(hasher)
+    return hasher.hexdigest()
+
+#the classifier only caches labels, it never changes a result
+ledger_cache_policy = TASK_SOURCE + (INPUTS - "classifier") + CacheKeyFnPolicy(cache_key_fn=id_format_key)
+
+seconds_per_day = 24 * 60 * 60
+
+def get_amount_cents(deltas : Series) -> numpy.ndarray :
+    return (deltas * 100).round().cast(Int64).to_numpy()
 
-@task(cache_policy=TASK_SOURCE + INPUTS)
-def verify_account_correspondence(from_account : Account, to_account : Account, mapping : InternalTransactionMapping) -> DataFrame :
+def match_transfers(from_transactions : DataFrame, to_transactions : DataFrame, date_window : int) -> typing.Tuple[DataFrame, DataFrame, DataFrame, DataFrame] :
+    #both sides sorted by amount then time and merged, each from transfer takes the earliest open to transfer of the opposite amount in the window
+    #a transfer too early for the other side's earliest is too early for all of it, so the greedy merge pairs as many as possible
+    window_seconds = date_window * seconds_per_day
+    from_amounts = get_amount_cents(from_transactions["delta"])
+    to_amounts = -get_amount_cents(to_transactions["delta"])
+    from_times = from_transactions["timestamp"].to_numpy()
+    to_times = to_transactions["timestamp"].to_numpy()
+    from_order = numpy.lexsort((from_times, from_amounts))
+    to_order = numpy.lexsort((to_times, to_amounts))
+
+    from_rows = []
+    to_rows = []
+    from_index = 0
+    to_index = 0
+    while from_index < len(from_order) and to_index < len(to_order) :
+        from_row = from_order[from_index]
+        to_row = to_order[to_index]
+        if from_amounts[from_row] != to_amounts[to_row] :
+            if from_amounts[from_row] < to_amounts[to_row] :
+                from_index += 1
+            else :
+                to_index += 1
+        elif to_times[to_row] < from_times[from_row] - window_seconds :
+            to_index += 1
+        elif from_times[from_row] < to_times[to_row] - window_seconds :
+            from_index += 1
+        else :
+            from_rows.append(from_row)
+            to_rows.append(to_row)
+            from_index += 1
+            to_index += 1
+
+    #pairs come back in from account order
+    pair_order = numpy.argsort(numpy.array(from_rows, dtype=numpy.int64), kind="stable")
+    from_rows_array = numpy.array(from_rows, dtype=numpy.int64)[pair_order]
+    to_rows_array = numpy.array(to_rows, dtype=numpy.int64)[pair_order]
+    from_unmatched = numpy.ones(from_transactions.height, dtype=bool)
+    from_unmatched[from_rows_array] = False
+    to_unmatched = numpy.ones(to_transactions.height, dtype=bool)
+    to_unmatched[to_rows_array] = False
+    return from_transactions[from_rows_array], to_transactions[to_rows_array], from_transactions.filter(from_unmatched), to_transactions.filter(to_unmatched)
+
+@task(cache_policy=ledger_cache_policy)
+def verify_account_correspondence(from_account : Account, to_account : Account, mapping : InternalTransactionMapping, classifier : TransactionClassifier | None = None) -> DataFrame :
     
-    from_matching_transactions = get_matched_transactions(from_account, mapping.from_match_strings)
-    to_matching_transactions = get_matched_transactions(to_account, mapping.to_match_strings)
+    from_matching_transactions = get_matcher(classifier)(from_account, mapping.from_match_strings)
+    to_matching_transactions = get_matcher(classifier)(to_account, mapping.to_match_strings)
 
     from_account_name = from_account.name
     to_account_name = to_account.name
 
-    #assumes in order on both accounts
-    matched_length = min(from_matching_transactions.height, to_matching_transactions.height)
-    from_matches_trunc = from_matching_transactions.head(matched_length)
-    to_matches_trunc = to_matching_transactions.head(matched_length)
-    if not from_matches_trunc["delta"].equals(-to_matches_trunc["delta"], strict=True) :
-        logger.info(f"Not in sync! Tried:\n\t{from_account_name}\nTo:\n\t{to_account_name}")
-          
+    from_matches, to_matches, from_unmatched, to_unmatched = match_transfers(from_matching_transactions, to_matching_transactions, mapping.date_window)
+
     #print missing transactions
-    print_missed_transactions = lambda name, data : logger.info(f"\"{name}\" missing {len(data)} transactions:\n{data.write_csv()}")
-    diff_from_to = to_matching_transactions.height - from_matching_transactions.height
-    if diff_from_to < 0 :
-        print_missed_transactions(to_account_name, from_matching_transactions.tail(-diff_from_to))
-    elif diff_from_to > 0 :
-        print_missed_transactions(from_account_name, to_matching_transactions.tail(diff_from_to))
-    if from_matching_transactions.height == 0 or to_matching_transactions.height == 0 :
+    print_missed_transactions = lambda name, data : logger.info(f"\"{name}\" missing {len(data)} transactions:\n{encode_transaction_ids(data).write_csv()}")
+    if from_unmatched.height > 0 :
+        print_missed_transactions(to_account_name, from_unmatched)
+    if to_unmatched.height > 0 :
+        print_missed_transactions(from_account_name, to_unmatched)
+    if from_matches.height == 0 :
         logger.info("... nothing to map!")
     else :
-        logger.info("... account mapped!")
+        logger.info(f"... account mapped! {from_matches.height} transfers paired within {mapping.date_window} days")
     
     internal_ledger_entries = DataFrame({
-        "from_account_name" : repeat(from_account_name, matched_length),
-        "from_transaction_id" : from_matches_trunc["ID"],
-        "to_account_name" : repeat(to_account_name, matched_length),
-        "to_transaction_id" : to_matches_trunc["ID"],
-        "delta" : from_matches_trunc["delta"].abs()
+        "from_account_name" : Series(values=repeat(from_account_name, from_matches.height), dtype=String),
+        "from_transaction_id" : from_matches["ID"],
+        "to_account_name" : Series(values=repeat(to_account_name, to_matches.height), dtype=String),
+        "to_transaction_id" : to_matches["ID"],
+        "delta" : from_matches["delta"].abs()
     })
     return internal_ledger_entries
     
-def verify_and_concat_ledger_entries(current_entries : DataFrame, new_ledger_entries : DataFrame) -> DataFrame :
-    assert new_ledger_entries.columns == ledger_columns, "Incompatible columns detected!"
-    new_ids = frozenset(concat([new_ledger_entries["from_transaction_id"], new_ledger_entries["to_transaction_id"]]))
-    if len(new_ids) > 0 :
-        current_accounted_ids = frozenset(concat([current_entries["from_transaction_id"], current_entries["to_transaction_id"]]))
-        assert new_ids.isdisjoint(current_accounted_ids), f"Duplicate unique hashes already existing in ledger:\n{list(new_ids - current_accounted_ids)}\n, likely double matched!"
-        return concat([current_entries, new_ledger_entries])
-    return current_entries
-
-def ledger_key(account_mapping : AccountMapping, source_accounts : SourceDataBase, task_source_object : typing.Any) -> str :
-    hasher = xxh128()
-    hash_object(hasher, account_mapping)
-    for account in source_accounts.get_names() :
-        hasher.update(source_accounts.get_account_hash(account))
-    hash_source(hasher, task_source_object)
-    return hasher.hexdigest()
+def make_empty_ledger_entries() -> DataFrame :
+    return DataFrame(schema={"from_account_name" : String, "from_transaction_id" : id_dtype, "to_account_name" : String, "to_transaction_id" : id_dtype, "delta" : Float64})
 
-def ledger_key_wrapper(run_context, parameters) :
-    return ledger_key(
-        parameters["account_mapping"], 
-        parameters["source_accounts"], 
-        run_context.task)
+def build_derived_ledger_entries(account_derivation : DerivedAccount, inputs : typing.List[typing.Any], classifier : TransactionClassifier | None = None) -> DataFrame :
+    return create_derived_matching_ledger_entries(inputs[0])
 
-@task(cache_key_fn=ledger_key_wrapper)
-def populate_ledger_entries(account_mapping : AccountMapping, source_accounts : SourceDataBase) -> DataFrame :
-    derived_ledger_entries = create_derived_ledger_entries(account_mapping.derived_accounts, source_accounts)
-    for mapping in account_mapping.internal_transactions :
-        if mapping.from_account != mapping.to_account :
-            logger.info(f"Mapping transactions from \"{mapping.from_account}\" to \"{mapping.to_account}\"")
-            from_account = source_accounts.get_account(mapping.from_account)
-            to_account = source_accounts.get_account(mapping.to_account)
-            new_ledger_entries = verify_account_correspondence(from_account, to_account, mapping)
-            derived_ledger_entries = verify_and_concat_ledger_entries(derived_ledger_entries, new_ledger_entries)
-        else :
-            logger.error(f"Transactions to same account {mapping.from_account}?")
-    return derived_ledger_entries
+def build_mapping_ledger_entries(mapping : InternalTransactionMapping, inputs : typing.List[typing.Any], classifier : TransactionClassifier | None = None) -> DataFrame :
+    logger.info(f"Mapping transactions from \"{mapping.from_account}\" to \"{mapping.to_account}\"")
+    from_account, to_account = inputs
+    return verify_account_correspondence(from_account, to_account, mapping, classifier)
 
-def get_ledger_entries_hash(account_mapping : AccountMapping, source_accounts : SourceDataBase) -> str :
-    return ledger_key(account_mapping, source_accounts, populate_ledger_entries)
+class LedgerEntryAccumulator :
 
-@flow
-def get_ledger_entries(account_mapping : AccountMapping, source_accounts : SourceDataBase) -> DataFrame :
-    return populate_ledger_entries(account_mapping, source_accounts)
-
-@task(cache_key_fn=ledger_key_wrapper)
-def filter_unaccounted_transactions(account_mapping : AccountMapping, source_accounts : SourceDataBase) -> DataFrame :
-    ledger_entries = get_ledger_entries(account_mapping, source_accounts)
-    accounted_transaction_ids = DataFrame(Series("ID", list(concat([ledger_entries["from_transaction_id"], ledger_entries["to_transaction_id"]]))))
-    unaccounted_transactions_data_frame_list = []
-    source_accout_datas = [source_accounts.get_account(account_name) for account_name in source_accounts.get_names()]
-    for account_data in source_accout_datas :
-        unaccounted_dataframe = (account_data.transactions
-            .join(accounted_transaction_ids, "ID", "anti")
-            .select(["date", "description", "delta"]))
-        account_column = Series("account", repeat(account_data.name, unaccounted_dataframe.height))
-        unaccounted_dataframe = unaccounted_dataframe.insert_column(unaccounted_dataframe.width, account_column)
-        unaccounted_transactions_data_frame_list.append(unaccounted_dataframe)
+    #every ID in the ledger sits in one growing index with the fragment that added it, fragments are concatenated once at the end
+    def __init__(self) :
+        self.__fragments : typing.List[DataFrame] = []
+        self.__id_sources : typing.Dict[int, str] = {}
+
+    @staticmethod
+    def __get_id_keys(ledger_entries : DataFrame) -> typing.List[int] :
+        id_words = get_id_words(concat([ledger_entries["from_transaction_id"], ledger_entries["to_transaction_id"]]))
+        return [(high << 64) | low for high, low in zip(id_words["high"].to_list(), id_words["low"].to_list())]
+
+    def add(self, fragment_name : str, ledger_entries : DataFrame, verify : bool = True) -> None :
+        assert ledger_entries.columns == ledger_columns, "Incompatible columns detected!"
+        if ledger_entries.height == 0 :
+            return
+        id_keys = LedgerEntryAccumulator.__get_id_keys(ledger_entries)
+        if verify :
+            collisions = {id_key : self.__id_sources[id_key] for id_key in set(id_keys) if id_key in self.__id_sources}
+            assert len(collisions) == 0, f"Duplicate unique hashes already existing in ledger, likely double matched!\n{LedgerEntryAccumulator.get_collision_report(fragment_name, collisions)}"
+        for id_key in id_keys :
+            self.__id_sources.setdefault(id_key, fragment_name)
+        self.__fragments.append(ledger_entries)
+
+    @staticmethod
+    def get_collision_report(fragment_name : str, collisions : typing.Dict[int, str]) -> str :
+        return "\n".join([f"{id_key:032x} matched by {collisions[id_key]} and {fragment_name}" for id_key in sorted(collisions.keys())])
+
+    def get_ledger_entries(self) -> DataFrame :
+        return concat(self.__fragments) if len(self.__fragments) > 0 else make_empty_ledger_entries()
+
+def build_ledger_entries(fragment_names : typing.Dict[str, typing.List[str]], inputs : typing.List[typing.Any], classifier : TransactionClassifier | None = None) -> DataFrame :
+    #derived fragments come first and are trusted, each mapping fragment is checked against everything before it
+    accumulator = LedgerEntryAccumulator()
+    derived_names = fragment_names["derived"]
+    for fragment_name, fragment in zip(derived_names + fragment_names["mappings"], inputs) :
+        accumulator.add(fragment_name, fragment, fragment_name not in derived_names)
+    return accumulator.get_ledger_entries()
+
+def make_empty_unaccounted_plan() -> LazyFrame :
+    return LazyFrame(schema={"account_index" : UInt32, "row" : UInt32, "account" : String, "high" : UInt64, "low" : UInt64, "date" : String, "description" : String, "delta" : Float64})
+
+def make_unaccounted_transactions_plan(accounts : typing.List[Account], ledger_entry_frames : typing.List[DataFrame]) -> LazyFrame :
+    #every account tagged with its name and position in one frame, anti-joined once against the distinct (account, ID) pairs of the ledger
+    transaction_frames = [make_empty_unaccounted_plan()]
+    for account_index, account in enumerate(accounts) :
+        if account.transactions.height > 0 :
+            transaction_frames.append(account.transactions.lazy()
+                .with_row_index("row")
+                .select(lit(account_index, UInt32).alias("account_index"), col("row"), lit(account.name, String).alias("account"), col("ID").struct.unnest(), col("date"), col("description"), col("delta")))
+    accounted_id_frames = [make_empty_ledger_entries().lazy().select(col("from_account_name").alias("account"), col("from_transaction_id").struct.unnest())]
+    for ledger_entries in ledger_entry_frames :
+        if ledger_entries.height > 0 :
+            accounted_id_frames.append(ledger_entries.lazy().select(col("from_account_name").alias("account"), col("from_transaction_id").struct.unnest()))
+            accounted_id_frames.append(ledger_entries.lazy().select(col("to_account_name").alias("account"), col("to_transaction_id").struct.unnest()))
+    accounted_transaction_ids = concat(accounted_id_frames).unique()
+    return (concat(transaction_frames)
+        .join(accounted_transaction_ids, on=["account"] + id_word_columns, how="anti")
+        .select(["account_index", "row", "date", "description", "delta", "account"]))
+
+def get_unaccounted_transactions_frame(accounts : typing.List[Account], ledger_entry_frames : typing.List[DataFrame]) -> DataFrame :
+    #the streaming engine does not keep row order through the join, the tagged positions restore it
+    unaccounted_transactions = make_unaccounted_transactions_plan(accounts, ledger_entry_frames).collect(streaming=True)
+    return unaccounted_transactions.sort(["account_index", "row"]).drop(["account_index", "row"])
+
+def build_unaccounted_transactions(account_name : str, inputs : typing.List[typing.Any], classifier : TransactionClassifier | None = None) -> DataFrame :
+    return get_unaccounted_transactions_frame([inputs[0]], inputs[1:])
+
+def build_unaccounted_transaction_table(source_account_names : typing.List[str], inputs : typing.List[typing.Any], classifier : TransactionClassifier | None = None) -> DataFrame :
+    unaccounted_transactions_data_frame_list = [fragment for fragment in inputs if fragment.height > 0]
     if len(unaccounted_transactions_data_frame_list) > 0 :
         unaccounted_transactions = concat(unaccounted_transactions_data_frame_list)
-        unaccounted_transactions = unaccounted_transactions.insert_column(0, Series("index", range(0, unaccounted_transactions.height)))
-    return unaccounted_transactions
+    else :
+        unaccounted_transactions = DataFrame(schema={"date" : String, "description" : String, "delta" : Float64, "account" : String})
+    return unaccounted_transactions.insert_column(0, Series("index", range(0, unaccounted_transactions.height)))
+
+ledger_entries_node = "LedgerEntries"
+unaccounted_transactions_node = "UnaccountedTransactions"
+balance_cube_node = "BalanceCube"
+
+def add_account_leaf(graph : BuildGraph, name : str, kind : str, accounts : SourceDataBase | DerivedDataBase, account_name : str) -> None :
+    def get_key() -> str :
+        return accounts.get_account_fingerprint(account_name).hex()
+    def get_value() -> Account :
+        return accounts.get_account(account_name)
+    graph.add_leaf(name, kind, get_key, get_value)
 
-def get_unaccounted_transactions_hash(account_mapping : AccountMapping, source_accounts : SourceDataBase) -> str :
-    return ledger_key(account_mapping, source_accounts, filter_unaccounted_transactions)
+def make_ledger_build_graph(account_mapping : AccountMapping, source_accounts : SourceDataBase, derived_accounts : DerivedDataBase) -> BuildGraph :
+    #one node per source account, derived account, mapping and table fragment, edges follow the account mapping
+    graph = BuildGraph()
+    source_account_names = source_accounts.get_account_names()
+    for account_name in source_account_names :
+        add_account_leaf(graph, f"Source {account_name}", "source account", source_accounts, account_name)
+
+    source_entry_names : typing.Dict[str, typing.List[str]] = {account_name : [] for account_name in source_account_names}
+    derived_entry_names = []
+    for account_derivation in account_mapping.derived_accounts :
+        derived_name = account_derivation.name
+        add_account_leaf(graph, f"Derived {derived_name}", "derived account", derived_accounts, derived_name)
+        entry_name = f"DerivedEntries {derived_name}"
+        graph.add_node(entry_name, "derived entries", [f"Derived {derived_name}"], account_derivation, build_derived_ledger_entries, [create_derived_matching_ledger_entries])
+        derived_entry_names.append(entry_name)
+        for account_name in get_derivation_source_names(source_accounts, account_derivation) :
+            source_entry_names.setdefault(account_name, []).append(entry_name)
+
+    mapping_entry_names = []
+    mapping_counts : typing.Dict[typing.Tuple[str, str], int] = {}
+    for mapping in account_mapping.internal_transactions :
+        if mapping.from_account == mapping.to_account :
+            logger.error(f"Transactions to same account {mapping.from_account}?")
+            continue
+        if mapping.from_account not in source_account_names or mapping.to_account not in source_account_names :
+            logger.error(f"Mapping from \"{mapping.from_account}\" to \"{mapping.to_account}\" needs accounts not in the source database!")
+            continue
+        #numbered per account pair, so editing one mapping leaves the names of the others alone
+        account_pair = (mapping.from_account, mapping.to_account)
+        mapping_counts[account_pair] = mapping_counts.get(account_pair, 0) + 1
+        entry_name = f"MappingEntries {mapping.from_account} {mapping.to_account} {mapping_counts[account_pair] - 1}"
+        graph.add_node(entry_name, "mapping entries", [f"Source {mapping.from_account}", f"Source {mapping.to_account}"], mapping, build_mapping_ledger_entries, [verify_account_correspondence.fn, get_matcher])
+        mapping_entry_names.append(entry_name)
+        source_entry_names[mapping.from_account].append(entry_name)
+        source_entry_names[mapping.to_account].append(entry_name)
+
+    graph.add_node(ledger_entries_node, "ledger table", derived_entry_names + mapping_entry_names, {"derived" : derived_entry_names, "mappings" : mapping_entry_names}, build_ledger_entries, [LedgerEntryAccumulator])
+
+    unaccounted_names = []
+    for account_name in source_account_names :
+        unaccounted_name = f"Unaccounted {account_name}"
+        graph.add_node(unaccounted_name, "unaccounted transactions", [f"Source {account_name}"] + source_entry_names[account_name], account_name, build_unaccounted_transactions)
+        unaccounted_names.append(unaccounted_name)
+    graph.add_node(unaccounted_transactions_node, "ledger table", unaccounted_names, source_account_names, build_unaccounted_transaction_table)
+
+    derived_account_names = [account_derivation.name for account_derivation in account_mapping.derived_accounts]
+    cube_account_names = source_account_names + derived_account_names
+    cube_inputs = [f"Source {account_name}" for account_name in source_account_names] + [f"Derived {derived_name}" for derived_name in derived_account_names]
+    graph.add_node(balance_cube_node, "ledger table", cube_inputs, cube_account_names, build_balance_cube)
+    return graph
+
+@flow
+def get_ledger_entries(account_mapping : AccountMapping, source_accounts : SourceDataBase, derived_accounts : DerivedDataBase, classifier : TransactionClassifier | None = None) -> DataFrame :
+    graph = make_ledger_build_graph(account_mapping, source_accounts, derived_accounts)
+    return graph.evaluate(ledger_entries_node, classifier or TransactionClassifier(account_mapping))
 
 @flow
-def get_unaccounted_transactions(account_mapping : AccountMapping, source_accounts : SourceDataBase) -> DataFrame :
-    return filter_unaccounted_transactions(account_mapping, source_accounts)
+def get_unaccounted_transactions(account_mapping : AccountMapping, source_accounts : SourceDataBase, derived_accounts : DerivedDataBase, classifier : TransactionClassifier | None = None) -> DataFrame :
+    graph = make_ledger_build_graph(account_mapping, source_accounts, derived_accounts)
+    return graph.evaluate(unaccounted_transactions_node, classifier or TransactionClassifier(account_mapping))
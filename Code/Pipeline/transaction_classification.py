@@ -0,0 +1,184 @@
+import typing
+from xxhash import xxh128
+from polars import DataFrame, Series, String, UInt32
+from polars import col, int_range, concat
+
+from Code.Utils.logger import get_logger
+logger = get_logger(__name__)
+
+from Code.Data.account_data import Account, AccountMapping, DataFrameObject
+from Code.Data.account_hashing import get_id_words
+from Code.Utils.json_serializer import json_serializer
+from Code.database import JsonDataBase
+from Code.object_cacher import ObjectCacher
+
+#characters escape_string passes through to the regex, strings holding any of them cannot be matched literally
+regex_characters = set(".?[]{}^$|\\")
+
+def escape_string(string : str) -> str :
+    return string.replace("*", "\*").replace("+", "\+").replace("(", "\(").replace(")", "\)")
+
+def strings_to_regex(strings : typing.List[str]) -> str :
+    return "|".join([escape_string(s) for s in strings])
+
+def is_literal_string(string : str) -> bool :
+    return len(string) > 0 and regex_characters.isdisjoint(string)
+
+def get_matched_transactions(match_account : Account, string_matches : typing.List[str]) -> DataFrame :
+    account_name = match_account.name
+    assert match_account is not None, f"Account not found! Expected account \"{account_name}\" to exist!"
+    logger.info(f"Checking account {account_name} with {len(match_account.transactions)} transactions")
+
+    regex = strings_to_regex(string_matches)
+    matched_transactions = match_account.transactions.filter(col("description").str.contains(regex))
+
+    logger.info(f"Found {matched_transactions.height} transactions in {account_name}")
+    return matched_transactions
+
+def get_rule_key(strings : typing.List[str] | typing.Tuple[str, ...]) -> str :
+    #a row matches if any string does, so order and repeats do not change the result
+    return json_serializer.write_to_string(sorted(set(strings)))
+
+def encode_rule_rows(labels : typing.Dict[typing.Tuple[str, ...], Series]) -> DataFrame :
+    #one row per match, rules without any keep a null row so they are still known
+    rule_frames = []
+    for rule, rows in labels.items() :
+        rows = rows if rows.len() > 0 else Series("row", [None], UInt32)
+        rule_frames.append(DataFrame({"rule" : Series("rule", [get_rule_key(rule)] * rows.len(), String), "row" : rows.cast(UInt32).alias("row")}))
+    if len(rule_frames) == 0 :
+        return DataFrame(schema={"rule" : String, "row" : UInt32})
+    return concat(rule_frames)
+
+def decode_rule_rows(frame : DataFrame) -> typing.Dict[str, Series] :
+    if "rule" not in frame.columns or frame.height == 0 :
+        return {}
+    return {str(rule_key) : rows["row"].drop_nulls().cast(UInt32).alias("row") for (rule_key,), rows in frame.partition_by("rule", as_dict=True, maintain_order=True).items()}
+
+def get_transactions_fingerprint(account : Account) -> bytes :
+    hasher = xxh128()
+    if account.transactions.height > 0 :
+        #derived IDs do not cover which source row they came from, so source IDs are part of it
+        for name in ["ID", "source_ID"] :
+            if name in account.transactions.columns :
+                id_words = get_id_words(account.transactions[name])
+                hasher.update(id_words["high"].to_numpy().tobytes())
+                hasher.update(id_words["low"].to_numpy().tobytes())
+    return hasher.digest()
+
+class TransactionClassifier :
+
+    #every match string list in the mapping is a rule, each source account is labelled with all its rules in one scan
+    #literal strings go through one Aho-Corasick pass, strings relying on regex syntax keep the regex path
+    #given a result database, matched rows are kept per source account version, only new or edited rules are scanned
+    def __init__(self, account_mapping : AccountMapping, result_db : JsonDataBase | None = None, hash_db : JsonDataBase | None = None) :
+        self.__rule_accounts : typing.Dict[typing.Tuple[str, ...], typing.Set[str] | None] = {}
+        for account_derivation in account_mapping.derived_accounts :
+            for matching in account_derivation.matchings :
+                self.__add_rule(matching.strings, None if matching.account_name == "" else matching.account_name)
+        for mapping in account_mapping.internal_transactions :
+            self.__add_rule(mapping.from_match_strings, mapping.from_account)
+            self.__add_rule(mapping.to_match_strings, mapping.to_account)
+        self.__labels : typing.Dict[str, typing.Tuple[bytes, typing.Dict[typing.Tuple[str, ...], Series]]] = {}
+        #result database and the manifest of fingerprints its frames were matched against, both or neither
+        self.__results : typing.Tuple[JsonDataBase, ObjectCacher] | None = None
+        if result_db is not None and hash_db is not None :
+            self.__results = (result_db, ObjectCacher(hash_db, "MatchResultHashes", DataFrameObject()))
+
+    def flush(self) -> None :
+        if self.__results is not None :
+            self.__results[1].flush()
+
+    def get_memory_size(self) -> int :
+        return sum(int(rows.estimated_size()) for _, labels in self.__labels.values() for rows in labels.values())
+
+    def release(self) -> None :
+        #labels come back from the result database or a rescan on next use
+        self.__labels.clear()
+
+    def __add_rule(self, strings : typing.List[str], account_name : str | None) -> None :
+        rule = tuple(strings)
+        if rule in self.__rule_accounts and self.__rule_accounts[rule] is None :
+            return
+        if account_name is None :
+            self.__rule_accounts[rule] = None
+        else :
+            account_names = self.__rule_accounts.setdefault(rule, set())
+            assert account_names is not None
+            account_names.add(account_name)
+
+    def __get_account_rules(self, account_name : str) -> typing.List[typing.Tuple[str, ...]] :
+        return [rule for rule, account_names in self.__rule_accounts.items() if account_names is None or account_name in account_names]
+
+    def __label_account(self, account : Account, rules : typing.List[typing.Tuple[str, ...]]) -> typing.Dict[typing.Tuple[str, ...], Series] :
+        descriptions = account.transactions["description"]
+        logger.info(f"Classifying {descriptions.len()} transactions of {account.name} with {len(rules)} rules")
+        literal_rules = [rule for rule in rules if len(rule) > 0 and all(is_literal_string(s) for s in rule)]
+        rule_patterns = DataFrame({
+            "rule" : Series([rule_index for rule_index, rule in enumerate(literal_rules) for _ in rule], dtype=UInt32),
+            "pattern" : Series([s for rule in literal_rules for s in rule], dtype=String)
+            })
+
+        #statements repeat the same descriptions, so the automaton only runs over the distinct ones
+        distinct_descriptions = descriptions.drop_nulls().unique()
+        rule_rows : typing.Dict[int, Series] = {}
+        if rule_patterns.height > 0 and distinct_descriptions.len() > 0 :
+            description_patterns = (DataFrame({"description" : distinct_descriptions, "pattern" : distinct_descriptions.str.extract_many(rule_patterns["pattern"].unique(), overlapping=True)})
+                .explode("pattern")
+                .drop_nulls("pattern"))
+            description_rules = description_patterns.join(rule_patterns, on="pattern").select(["description", "rule"]).unique()
+            row_rules = (DataFrame({"description" : descriptions, "row" : int_range(0, descriptions.len(), dtype=UInt32, eager=True)})
+                .join(description_rules, on="description")
+                .sort("row"))
+            rule_rows = {typing.cast(int, rule_index) : rows["row"] for (rule_index,), rows in row_rules.partition_by("rule", as_dict=True).items()}
+
+        labels = {}
+        for rule_index, rule in enumerate(literal_rules) :
+            labels[rule] = rule_rows.get(rule_index, Series("row", [], UInt32))
+        for rule in rules :
+            if rule not in labels :
+                #regex syntax or an empty string, matched the same way as before
+                labels[rule] = descriptions.str.contains(strings_to_regex(list(rule))).arg_true().cast(UInt32).alias("row")
+        return labels
+
+    def __load_labels(self, account_name : str, fingerprint : str, rules : typing.List[typing.Tuple[str, ...]]) -> typing.Dict[typing.Tuple[str, ...], Series] :
+        if self.__results is None :
+            return {}
+        result_db, result_cache = self.__results
+        if result_cache.get_stored_hash(account_name) != fingerprint or not result_db.is_stored(account_name) :
+            return {}
+        stored_rows = decode_rule_rows(result_db.retrieve(account_name, DataFrameObject).frame)
+        labels = {}
+        for rule in rules :
+            rule_key = get_rule_key(rule)
+            if rule_key in stored_rows :
+                labels[rule] = stored_rows[rule_key]
+        return labels
+
+    def __get_labels(self, account : Account) -> typing.Dict[typing.Tuple[str, ...], Series] :
+        fingerprint = get_transactions_fingerprint(account)
+        if account.name not in self.__labels or self.__labels[account.name][0] != fingerprint :
+            rules = self.__get_account_rules(account.name)
+            labels = self.__load_labels(account.name, fingerprint.hex(), rules)
+            new_rules = [rule for rule in rules if rule not in labels]
+            if len(new_rules) > 0 :
+                labels.update(self.__label_account(account, new_rules))
+                if self.__results is not None :
+                    #rules no longer in the mapping are dropped along the way
+                    result_db, result_cache = self.__results
+                    result_cache.store_object(result_db, account.name, fingerprint.hex(), DataFrameObject(encode_rule_rows(labels)))
+            else :
+                logger.info(f"Matched rows of all {len(rules)} rules for {account.name} read from cache")
+            self.__labels[account.name] = (fingerprint, labels)
+        return self.__labels[account.name][1]
+
+    def get_matched_transactions(self, match_account : Account, string_matches : typing.List[str]) -> DataFrame :
+        assert match_account is not None, "Account not found!"
+        if "description" not in match_account.transactions.columns :
+            return get_matched_transactions(match_account, string_matches)
+        labels = self.__get_labels(match_account)
+        rule = tuple(string_matches)
+        if rule not in labels :
+            return get_matched_transactions(match_account, string_matches)
+        matched_transactions = match_account.transactions[labels[rule]]
+        logger.info(f"Found {matched_transactions.height} transactions in {match_account.name}")
+        return matched_transactions
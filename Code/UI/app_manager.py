@@ -1,9 +1,10 @@
 import pathlib
 import typing
 import datetime
+from threading import Thread
 from re import compile as compile_expression
 from re import sub as replace_matched
-from polars import DataFrame, concat
+from polars import DataFrame, col
 from pathlib import Path
 from numpy import Inf
 
@@ -12,13 +13,15 @@ from kivy.uix.anchorlayout import AnchorLayout
 from kivy.uix.screenmanager import ScreenManager, Screen, WipeTransition
 from kivy.uix.textinput import TextInput
 from kivy.uix.treeview import TreeViewNode, TreeViewLabel
+from kivy.clock import Clock
 from kivy.logger import Logger
 
 import matplotlib.pyplot as plot_system
 from Code.UI.nametreeviewer import NameTreeViewer
 from Code.accounting import Ledger, LedgerImport
-from Code.ledger_database import make_account_data_table
 from Code.ledger_database import get_ledger_configuration
+from Code.ledger_pool import LedgerPool
+from Code.Utils.load_progress import LoadProgress, LoadCancelled, imported_stage, derived_stage, validated_stage
 
 class LedgerNameInput(TextInput) :
 
@@ -52,6 +55,38 @@ class LedgerCreator(Screen) :
 
         self.manager.load_ledger(ledger_path)
 
+class LedgerLoading(Screen) :
+
+    stage_label = ObjectProperty(None)
+    stage_progress = ObjectProperty(None)
+
+    #each stage fills a third of the bar
+    stages = [imported_stage, derived_stage, validated_stage]
+
+    def __init__(self, ledger_name : str, **kwargs : typing.ParamSpecKwargs) -> None :
+        super(LedgerLoading, self).__init__(**kwargs)
+
+        self.ledger_name = ledger_name
+        self.progress = LoadProgress(self.__on_progress)
+        self.stage_label.text = f"Loading {ledger_name}..."
+
+    def __on_progress(self, stage : str, done : int, total : int) -> None :
+        #called on the loading thread, widgets are only touched on the main thread
+        Clock.schedule_once(lambda _ : self.show_progress(stage, done, total))
+
+    def show_progress(self, stage : str, done : int, total : int) -> None :
+        if self.progress.is_cancelled() :
+            return
+        stage_index = LedgerLoading.stages.index(stage) if stage in LedgerLoading.stages else 0
+        stage_fraction = done / total if total > 0 else 1.0
+        self.stage_progress.value = 100 * (stage_index + stage_fraction) / len(LedgerLoading.stages)
+        self.stage_label.text = f"{self.ledger_name} : {stage} ({done}/{total})"
+
+    def cancel(self) -> None :
+        Logger.info(f"[LedgerLoading] cancelling load of {self.ledger_name}")
+        self.progress.cancel()
+        self.stage_label.text = f"Cancelling {self.ledger_name}..."
+
 class LedgerAccountTreeViewNode(AnchorLayout, TreeViewNode) :
 
     account_name_entry = ObjectProperty(None)
@@ -83,7 +118,7 @@ class LedgerViewer(Screen) :
 
     def __view_account_transactions(self, account_name : str) -> None :
         try :
-            account_data = make_account_data_table(self.ledger.get_account(account_name))
+            account_data = self.ledger.get_account_data_table(account_name)
             new_screen = AccountViewer(account_name, account_data, ["date", "description", "delta", "balance"], [0.1, 0.70, 0.08, 0.12])
             self.manager.push_overlay(new_screen)
         except Exception as e :
@@ -118,48 +153,10 @@ class AnalyzeLedgerTreeIncludeNode(AnchorLayout, TreeViewNode) :
 
 TransactionGroupDict = typing.Dict[str, DataFrame]
 
-def get_full_subtree_timeseries(ledger : Ledger, leaf_accounts : typing.List[str]) -> DataFrame :
-    
-    total_start_value : float = 0.0
-    df_list = []
-    for account_name in leaf_accounts :
-        account = ledger.get_account(account_name)
-        total_start_value -= account.start_value
-        df_list.append(DataFrame({
-            "timestamp" : account.transactions["timestamp"],
-            "delta" : -account.transactions["delta"]
-        }))
-    
-    subtree_timeseries = concat(df_list).sort("timestamp", maintain_order=True)
-    subtree_timeseries = subtree_timeseries.groupby("timestamp").sum()
-    subtree_timeseries["delta"] = total_start_value + subtree_timeseries["delta"].cumsum()
-
-    first_row = DataFrame({"timestamp": [0.0], "balance": [total_start_value]})
-    balances = DataFrame({"timestamp": subtree_timeseries["timestamp"], "balance": total_start_value + subtree_timeseries["delta"].cumsum()})
-    return concat([first_row, balances])
-
-def query_frame(df : DataFrame, condition_string : str) -> DataFrame :
-    df.sql(f"SELECT * FROM self WHERE {condition_string}")
-    return df
-
-
 def collect_subtree_timeseries(ledger : Ledger, leaf_accounts : typing.List[str], start_time_point : float, end_time_point : float) -> DataFrame :
-    
-    subtree_timeseries = get_full_subtree_timeseries(ledger, leaf_accounts)
-
-    existing_start_time_point = query_frame(subtree_timeseries, f"timestamp == {start_time_point}")
-    if len(existing_start_time_point) == 0 :
-        earlier_timepoints = query_frame(subtree_timeseries, f"timestamp < {start_time_point}")
-        select_first_row = DataFrame({"timestamp": [start_time_point], "balance": earlier_timepoints.tail(1)["balance"]}) #assume one row
-        subtree_timeseries = concat([select_first_row, subtree_timeseries])
-
-    existing_end_time_point = query_frame(subtree_timeseries, f"timestamp == {end_time_point}")
-    if len(existing_end_time_point) == 0 :
-        earlier_timepoints = query_frame(subtree_timeseries, f"timestamp < {end_time_point}")
-        select_last_row = DataFrame({"timestamp": [end_time_point], "balance": earlier_timepoints.tail(1)["balance"]}) #assume one row
-        subtree_timeseries = concat([subtree_timeseries, select_last_row])
-        
-    return query_frame(query_frame(subtree_timeseries, f"timestamp >= {start_time_point}"), f"timestamp <= {end_time_point}")
+    #daily from the ledger's balance cube, expenses negated so they plot upwards
+    subtree_timeseries = ledger.get_balance_cube().get_balances(leaf_accounts, start_time_point, end_time_point)
+    return subtree_timeseries.with_columns(-col("balance"))
 
 def get_selected_account_sets(ledger : Ledger, tree_view : NameTreeViewer, start_time_point : float, end_time_point : float) -> TransactionGroupDict :
     transaction_groups : TransactionGroupDict = {}
@@ -242,8 +239,9 @@ class DataPlotter(Screen) :
         assert self.series_scale_radio.active != self.total_scale_radio.active
         is_series = self.series_scale_radio.active
 
-        from_time_point = datetime.datetime.strptime(self.from_date_textbox.text, "%Y-%b-%d").timestamp()
-        to_time_point = datetime.datetime.strptime(self.to_date_textbox.text, "%Y-%b-%d").timestamp()
+        #transaction timestamps are dates at utc midnight
+        from_time_point = datetime.datetime.strptime(self.from_date_textbox.text, "%Y-%b-%d").replace(tzinfo=datetime.timezone.utc).timestamp()
+        to_time_point = datetime.datetime.strptime(self.to_date_textbox.text, "%Y-%b-%d").replace(tzinfo=datetime.timezone.utc).timestamp()
 
         if from_time_point <= to_time_point :
 
@@ -280,12 +278,20 @@ class AccountViewer(Screen) :
 
         self.account_name_label.text = account_name
         self.account_data_table.set_data_frame(account_data, column_name_order, column_relative_sizes)
-
-    def filter_by_description(self, match_string : str) -> None :
-        if match_string == "" :
-            self.account_data_table.filter_by(lambda df : df)
+        #typing restarts the wait, the search runs once the query settles
+        self.pending_match_string = ""
+        self.filter_trigger = Clock.create_trigger(self.__apply_description_filter, 0.25)
+
+    def filter_by_description(self, match_string : str, immediate : bool = False) -> None :
+        self.pending_match_string = match_string
+        self.filter_trigger.cancel()
+        if immediate :
+            self.__apply_description_filter(0.0)
         else :
-            self.account_data_table.filter_by(lambda df : df[df['Description'].str.contains(match_string, regex=False)])
+            self.filter_trigger()
+
+    def __apply_description_filter(self, _ : float) -> None :
+        self.account_data_table.search("description", self.pending_match_string)
 
 class StockedUpAppManager(ScreenManager) :
 
@@ -296,7 +302,11 @@ class StockedUpAppManager(ScreenManager) :
         self.ledger_configuration = get_ledger_configuration(data_dir)
 
         self.__overlay_stack : typing.List[Screen] = []
-        self.__ledgers : typing.Dict[str, Ledger] = {}
+        self.__ledgers = LedgerPool(self.ledger_configuration.ledger_memory_budget)
+        self.__loading : typing.Dict[str, LedgerLoading] = {}
+        #callbacks waiting on a ledger still loading
+        self.__on_imported : typing.Dict[str, typing.List[typing.Callable[[], None]]] = {}
+        self.prepare_ledgers()
 
     def swap_screen(self, screen_name : str) -> typing.Any :
         Logger.info(f"[StockedUpAppManager] swap_screen {screen_name}")
@@ -329,27 +339,68 @@ class StockedUpAppManager(ScreenManager) :
         self.remove_widget(self.__overlay_stack.pop())
         return next_screen
 
-    def import_ledger(self, ledger_import : LedgerImport) -> None :
-        assert ledger_import.ledger_name not in self.__ledgers
-        self.__ledgers[ledger_import.ledger_name] = Ledger(self.data_root_directory, ledger_import)
+    def prepare_ledgers(self) -> None :
+        #every configured ledger is built in the background at once, viewing one waits on its loading screen
+        for ledger_import in self.ledger_configuration.ledgers :
+            if ledger_import.ledger_name not in self.__ledgers :
+                self.import_ledger(ledger_import)
+
+    def import_ledger(self, ledger_import : LedgerImport, on_imported : typing.Callable[[], None] | None = None, show_progress : bool = False) -> None :
+        #built on a worker thread, results come back on the main thread
+        ledger_name = ledger_import.ledger_name
+        assert ledger_name not in self.__ledgers
+        if ledger_name not in self.__loading :
+            loading_screen = LedgerLoading(ledger_name)
+            self.__loading[ledger_name] = loading_screen
+
+            def build_ledger() -> None :
+                try :
+                    ledger = Ledger(self.data_root_directory, ledger_import, loading_screen.progress)
+                    Clock.schedule_once(lambda _ : self.__on_ledger_imported(loading_screen, ledger))
+                except LoadCancelled :
+                    Clock.schedule_once(lambda _ : self.__on_ledger_imported(loading_screen, None))
+                except Exception as e :
+                    Logger.error(f"[StockedUpAppManager] Failed to load {ledger_name}, hit :\n{e}")
+                    Clock.schedule_once(lambda _ : self.__on_ledger_imported(loading_screen, None))
+            Thread(target=build_ledger, name=f"Load {ledger_name}", daemon=True).start()
+
+        if on_imported is not None :
+            self.__on_imported.setdefault(ledger_name, []).append(on_imported)
+        loading_screen = self.__loading[ledger_name]
+        if show_progress and (len(self.__overlay_stack) == 0 or self.__overlay_stack[-1] is not loading_screen) :
+            self.push_overlay(loading_screen)
+
+    def __on_ledger_imported(self, loading_screen : LedgerLoading, ledger : Ledger | None) -> None :
+        ledger_name = loading_screen.ledger_name
+        del self.__loading[ledger_name]
+        on_imported = self.__on_imported.pop(ledger_name, [])
+        if len(self.__overlay_stack) > 1 and self.__overlay_stack[-1] is loading_screen :
+            self.pop_overlay()
+        if ledger is None or loading_screen.progress.is_cancelled() :
+            Logger.info(f"[StockedUpAppManager] {ledger_name} not loaded")
+            return
+        self.__ledgers.add(ledger_name, ledger)
+        for callback in on_imported :
+            callback()
 
     def import_ledgers(self) :
-        Logger.info("[StockedUpAppManager] import_ledgers called, only importing FIRST ledger")
+        Logger.info("[StockedUpAppManager] import_ledgers called")
         if len(self.ledger_configuration.ledgers) == 0 :
             Logger.warning("No ledgers to import!")
             return
-        #for ledger_import in self.ledger_configuration.ledgers :
-        self.import_ledger(self.ledger_configuration.ledgers[0])
-            
+        self.prepare_ledgers()
         self.load_default_ledger()
 
     def load_ledger(self, ledger_name : str) -> None :
         if not (ledger_name in self.__ledgers) :
             for ledger_import in self.ledger_configuration.ledgers :
                 if ledger_import.ledger_name == ledger_name :
-                    self.import_ledger(ledger_import)
+                    self.import_ledger(ledger_import, lambda : self.load_ledger(ledger_name), True)
+                    return
+            Logger.error(f"[StockedUpAppManager] No ledger named {ledger_name} configured!")
+            return
 
-        ledger = self.__ledgers[ledger_name]
+        ledger = self.__ledgers.get(ledger_name)
 
         ledger_viewer = LedgerViewer()
         ledger_viewer.set_ledger(ledger)
@@ -1,18 +1,45 @@
 import typing
 import math
-from polars import DataFrame
+from polars import DataFrame, Series, Boolean
+from polars import repeat
 
 from kivy.metrics import mm
+from kivy.factory import Factory
 from kivy.properties import ObjectProperty, NumericProperty
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.floatlayout import FloatLayout
-from kivy.uix.recycleview import RecycleView
+from kivy.uix.stencilview import StencilView
 from kivy.logger import Logger
 
 # adapted from https://stackoverflow.com/questions/44463773/kivy-recycleview-recyclegridlayout-scrollable-label-problems#comment75948118_44463773
 # and from https://github.com/jefpadfi/PandasDataframeGUIKivy/blob/master/pdfkivygui/dfguik.py
 
+#rows drawn past the viewport, so a partly scrolled row never shows a gap
+table_overscan_rows = 2
+#rows moved per mouse wheel step
+table_scroll_rows = 3
+#added for the length of a filter, so the kept rows can be read back
+table_row_column = "__table_row"
+
+class TableModel :
+
+    #the frame stays the backing store, cells are only formatted for the rows on screen
+    #sorting and filtering only swap the row order shown, the frame is never copied
+    def __init__(self, dataframe : DataFrame, column_names : typing.List[str]) :
+        self.frame = dataframe.select(column_names)
+        self.rows : Series | None = None
+
+    def set_rows(self, rows : Series | None) -> None :
+        self.rows = rows
+
+    def get_row_count(self) -> int :
+        return self.frame.height if self.rows is None else self.rows.len()
+
+    def get_rows(self, first_row : int, row_count : int) -> typing.List[typing.List[str]] :
+        window = self.frame.slice(first_row, row_count) if self.rows is None else self.frame[self.rows.slice(first_row, row_count)]
+        return [[str(value) for value in row] for row in window.iter_rows()]
+
 class TableHeaderCell(Button) :
     pass
 
@@ -24,26 +51,90 @@ class TableHeader(BoxLayout) :
             relative_size = columns_relative_size[idx]
             self.add_widget(TableHeaderCell(text=column_name, size_hint_x=relative_size))
 
-class TableData(RecycleView) :
+class TableRow(BoxLayout) :
 
-    table_grid_layout = ObjectProperty(None)
+    def populate(self, columns_relative_size : typing.List[float]) -> None :
+        for relative_size in columns_relative_size :
+            self.add_widget(Factory.TableDataCell(size_hint_x=relative_size))
 
-    def populate(self, row_dictionaries : typing.List[typing.Dict[str, typing.Any]], column_names : typing.List[str], columns_relative_size : typing.List[float]) -> None :
-        self.table_grid_layout.bind(minimum_height = self.table_grid_layout.setter("height"))
+    def show(self, row_index : int, values : typing.List[str] | None) -> None :
+        self.opacity = 0 if values is None else 1
+        if values is None :
+            return
+        #children are in reverse order of adding
+        for cell, value in zip(reversed(self.children), values) :
+            cell.text = value
+            cell.background_color = [0.4, 0.4, 0.4, 1] if (row_index % 2 == 0) else [0.25, 0.25, 0.25, 1]
 
-        columns_sizes = {}
-        for idx, relative_size in enumerate(columns_relative_size) :
-            columns_sizes[idx] = relative_size * self.parent.width
-        self.table_grid_layout.cols_minimum = columns_sizes
-        
-        self.data = []
-        for i, row in enumerate(row_dictionaries) :
-            for j in range(len(column_names)) :
-                self.data.append({
-                    "text" : str(row[column_names[j]]),
-                    "background_color" : [0.4, 0.4, 0.4, 1] if (i % 2 == 0) else [0.25, 0.25, 0.25, 1],
-                    "size_hint_x" : columns_relative_size[j],
-                    "height" : mm(8)})
+class TableRows(StencilView) :
+    pass
+
+class TableData(BoxLayout) :
+
+    table_rows = ObjectProperty(None)
+    scroll_bar = ObjectProperty(None)
+
+    row_height = NumericProperty(mm(8))
+    #pixels scrolled from the top row
+    scroll_offset = NumericProperty(0)
+
+    def populate(self, model : TableModel, columns_relative_size : typing.List[float]) -> None :
+        #a fixed pool of row widgets is moved over the frame, the view costs the same at any row count
+        self.model = model
+        self.columns_relative_size = columns_relative_size
+        self.row_pool : typing.List[TableRow] = []
+        self.table_rows.bind(size=self.__layout_rows, pos=self.__layout_rows)
+        self.scroll_bar.bind(value=self.__on_scroll_bar)
+        self.bind(scroll_offset=self.__show_rows)
+        self.__layout_rows()
+
+    def refresh(self) -> None :
+        self.__layout_rows()
+
+    def get_max_offset(self) -> float :
+        return max(0.0, self.model.get_row_count() * self.row_height - self.table_rows.height)
+
+    def scroll_to(self, offset : float) -> None :
+        self.scroll_offset = min(max(0.0, offset), self.get_max_offset())
+
+    def on_touch_down(self, touch : typing.Any) -> bool :
+        if self.table_rows.collide_point(*touch.pos) and touch.is_mouse_scrolling :
+            if touch.button == "scrollup" :
+                self.scroll_to(self.scroll_offset + table_scroll_rows * self.row_height)
+            elif touch.button == "scrolldown" :
+                self.scroll_to(self.scroll_offset - table_scroll_rows * self.row_height)
+            return True
+        return super(TableData, self).on_touch_down(touch)
+
+    def __on_scroll_bar(self, _ : typing.Any, value : float) -> None :
+        #bar runs bottom to top
+        self.scroll_to(self.scroll_bar.max - value)
+
+    def __layout_rows(self, *_ : typing.Any) -> None :
+        pool_size = math.ceil(self.table_rows.height / self.row_height) + table_overscan_rows
+        while len(self.row_pool) < pool_size :
+            row = TableRow(size_hint=(None, None))
+            row.populate(self.columns_relative_size)
+            self.table_rows.add_widget(row)
+            self.row_pool.append(row)
+        while len(self.row_pool) > pool_size :
+            self.table_rows.remove_widget(self.row_pool.pop())
+
+        max_offset = self.get_max_offset()
+        self.scroll_bar.max = max(max_offset, 1.0)
+        self.scroll_bar.disabled = max_offset == 0
+        self.scroll_to(self.scroll_offset)
+        self.__show_rows()
+
+    def __show_rows(self, *_ : typing.Any) -> None :
+        first_row = int(self.scroll_offset // self.row_height)
+        row_shift = self.scroll_offset - first_row * self.row_height
+        row_values = self.model.get_rows(first_row, len(self.row_pool))
+        for pool_index, row in enumerate(self.row_pool) :
+            row.size = (self.table_rows.width, self.row_height)
+            row.pos = (self.table_rows.x, self.table_rows.top - (pool_index + 1) * self.row_height + row_shift)
+            row.show(first_row + pool_index, row_values[pool_index] if pool_index < len(row_values) else None)
+        self.scroll_bar.value = self.scroll_bar.max - self.scroll_offset
 
 class Table(BoxLayout) :
 
@@ -59,8 +150,14 @@ class Table(BoxLayout) :
         self.nrows = len(dataframe)
         self.ncols = len(dataframe.columns)
 
+        self.model = TableModel(dataframe, column_name_order)
         self.table_header.populate(column_name_order, column_relative_sizes)
-        self.table_data.populate(dataframe.to_dicts(), column_name_order, column_relative_sizes)
+        self.table_data.populate(self.model, column_relative_sizes)
+
+    def set_rows(self, rows : Series) -> None :
+        self.nrows = rows.len()
+        self.model.set_rows(rows)
+        self.table_data.refresh()
 
 DataFrameTransform = typing.Callable[[DataFrame], DataFrame]
 
@@ -69,7 +166,7 @@ class DataFrameTable(FloatLayout) :
     def __init__(self, **kwargs) :
         super(DataFrameTable, self).__init__(**kwargs)
 
-        self.sorting_by_column = None
+        self.sorting_by_column : str | None = None
         self.ascending = True
         
         self.query_expression : DataFrameTransform = lambda df : df
@@ -86,7 +183,18 @@ class DataFrameTable(FloatLayout) :
         self.dataframe = dataframe
         self.column_order = column_name_order
         self.relative_sizes = column_relative_sizes
-        self.sort_by(self.dataframe.columns[0])
+        #kept until the frame changes, sorting and filtering then only combine them
+        self.sort_permutations : typing.Dict[typing.Tuple[str, bool], Series] = {}
+        self.filter_mask : Series | None = None
+        #lowercased once, so searching ignores case at the cost of a literal scan
+        self.search_columns : typing.Dict[str, Series] = {}
+        #column, text and kept rows of the last search, a longer query only rechecks those rows
+        self.last_search : typing.Tuple[str, str, Series] | None = None
+        self.sorting_by_column = None
+        self.clear_widgets()
+        self.table = Table(self.dataframe, self.column_order, self.relative_sizes)
+        self.add_widget(self.table)
+        self.sort_by(self.column_order[0])
 
     def sort_by(self, sort_by_column : str) -> None :
         assert sort_by_column in self.dataframe.columns
@@ -99,13 +207,49 @@ class DataFrameTable(FloatLayout) :
 
     def filter_by(self, expression : DataFrameTransform) -> None :
         self.query_expression = expression
+        self.filter_mask = None
+        self.last_search = None
         self.__refresh()
 
+    def search(self, column_name : str, text : str) -> None :
+        assert column_name in self.dataframe.columns
+        if text == "" :
+            self.filter_by(lambda df : df)
+            return
+        if column_name not in self.search_columns :
+            self.search_columns[column_name] = self.dataframe[column_name].cast(str).str.to_lowercase()
+        search_column = self.search_columns[column_name]
+        search_text = text.lower()
+
+        if self.last_search is not None and self.last_search[0] == column_name and search_text.startswith(self.last_search[1]) :
+            candidate_rows = self.last_search[2]
+            kept_rows = candidate_rows.filter(search_column.gather(candidate_rows).str.contains(search_text, literal=True).fill_null(False))
+        else :
+            kept_rows = search_column.str.contains(search_text, literal=True).fill_null(False).arg_true()
+        self.query_expression = lambda df : df
+        self.filter_mask = repeat(False, self.dataframe.height, dtype=Boolean, eager=True).scatter(kept_rows, True)
+        self.last_search = (column_name, search_text, kept_rows)
+        self.__refresh()
+
+    def __get_sort_permutation(self, column_name : str, descending : bool) -> Series :
+        #one per direction, reversing the ascending order would move nulls last and flip ties
+        sort_key = (column_name, descending)
+        if sort_key not in self.sort_permutations :
+            self.sort_permutations[sort_key] = self.dataframe[column_name].arg_sort(descending=descending, nulls_last=False)
+        return self.sort_permutations[sort_key]
+
+    def __get_filter_mask(self) -> Series :
+        if self.filter_mask is None :
+            row_index = self.dataframe.with_row_index(table_row_column)
+            try :
+                kept_rows = self.query_expression(row_index)[table_row_column]
+                self.filter_mask = row_index[table_row_column].is_in(kept_rows)
+            except Exception as e :
+                Logger.error(f"[DataFrameTable] Query failed! {e}")
+                self.filter_mask = row_index[table_row_column].is_not_null()
+        return self.filter_mask
+
     def __refresh(self) :
-        display_df = self.dataframe.sort(self.sorting_by_column, descending=self.descending)
-        try :
-            display_df = self.query_expression(display_df)
-        except Exception as e :
-            Logger.error(f"[DataFrameTable] Query failed! {e}")
-        self.clear_widgets()
-        self.add_widget(Table(display_df, self.column_order, self.relative_sizes))
+        assert self.sorting_by_column is not None
+        permutation = self.__get_sort_permutation(self.sorting_by_column, self.descending)
+        self.table.set_rows(permutation.filter(self.__get_filter_mask().gather(permutation)))
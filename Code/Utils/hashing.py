@@ -1,4 +1,7 @@
 import typing
+from os import scandir
+from weakref import WeakKeyDictionary
+from threading import RLock, local
 from xxhash import xxh128
 from pathlib import Path
 from inspect import getsource
@@ -6,35 +9,118 @@ from polars import Series, DataFrame, concat, String
 
 from Code.Utils.json_serializer import json_serializer
 
-def hash_float(hasher : typing.Any, float_number : float) -> None :
+class KeyCache :
+
+    #memoizes the bytes the key hashers are fed, so keys come out exactly as if computed from scratch
+    #sources are fixed for the process, configuration objects are assumed immutable while alive, edits load new objects,
+    #directories are trusted for the rest of a session once rescanned
+    #ledgers build on their own threads, so sessions are per thread and the shared memos are locked
+    def __init__(self) :
+        self.__sources : typing.Dict[int, typing.Tuple[typing.Any, bytes]] = {}
+        self.__objects : WeakKeyDictionary = WeakKeyDictionary()
+        self.__thread_state = local()
+        self.__stats : typing.Dict[str, typing.List[int]] = {"source" : [0, 0], "object" : [0, 0], "path" : [0, 0]}
+        self.__lock = RLock()
+
+    def __get_paths(self) -> typing.Dict[str, bytes] | None :
+        #threads that never began a session rescan every time
+        return getattr(self.__thread_state, "paths", None)
+
+    def begin_session(self) -> None :
+        self.__thread_state.paths = {}
+
+    def __count(self, kind : str, hit : bool) -> None :
+        with self.__lock :
+            self.__stats[kind][0 if hit else 1] += 1
+
+    def get_stats(self) -> typing.Dict[str, typing.Tuple[int, int]] :
+        with self.__lock :
+            return {kind : (hits, misses) for kind, (hits, misses) in self.__stats.items()}
+
+    def get_source_bytes(self, source_object : typing.Any) -> bytes :
+        with self.__lock :
+            if id(source_object) in self.__sources :
+                self.__stats["source"][0] += 1
+                return self.__sources[id(source_object)][1]
+        self.__count("source", False)
+        source_bytes = getsource(source_object).encode()
+        with self.__lock :
+            #object kept alive so its id is never reused
+            self.__sources[id(source_object)] = (source_object, source_bytes)
+        return source_bytes
+
+    def get_object_bytes(self, some_object : typing.Any) -> bytes :
+        with self.__lock :
+            try :
+                if some_object in self.__objects :
+                    self.__stats["object"][0] += 1
+                    return self.__objects[some_object]
+            except TypeError :
+                pass
+        self.__count("object", False)
+        object_bytes = json_serializer.write_to_string(some_object).encode("utf-8")
+        with self.__lock :
+            try :
+                self.__objects[some_object] = object_bytes
+            except TypeError :
+                #not weak referenceable or hashable, never memoized
+                pass
+        return object_bytes
+
+    def get_path_bytes(self, path : Path) -> bytes :
+        path_key = str(path)
+        paths = self.__get_paths()
+        if paths is not None and path_key in paths :
+            self.__count("path", True)
+            return paths[path_key]
+        self.__count("path", False)
+        path_bytes = get_path_stat_bytes(path)
+        if paths is not None :
+            paths[path_key] = path_bytes
+        return path_bytes
+
+key_cache = KeyCache()
+
+def get_float_bytes(float_number : float) -> bytes :
     num, den = float_number.as_integer_ratio()
-    hasher.update(num.to_bytes(8, 'big', signed=True))
-    hasher.update(den.to_bytes(8, 'big'))
+    return num.to_bytes(8, 'big', signed=True) + den.to_bytes(8, 'big')
+
+def hash_float(hasher : typing.Any, float_number : float) -> None :
+    hasher.update(get_float_bytes(float_number))
 
 def hash_string(hasher : typing.Any, string : str) -> None :
     hasher.update(string.encode())
 
 def hash_object(hasher : typing.Any, some_object : typing.Any) -> None :
-    hasher.update(json_serializer.write_to_string(some_object).encode("utf-8"))
+    hasher.update(key_cache.get_object_bytes(some_object))
+
+def get_stat_bytes(file_stat : typing.Any) -> bytes :
+    return get_float_bytes(file_stat.st_mtime) + get_float_bytes(file_stat.st_ctime) + file_stat.st_size.to_bytes(8)
+
+def get_path_stat_bytes(path : Path) -> bytes :
+    #same bytes hash_file would feed for every file under path, in the same sorted order
+    if path.is_file() :
+        return get_stat_bytes(path.stat())
+    path_bytes = []
+    if path.is_dir() :
+        with scandir(path) as entries :
+            sorted_entries = sorted(entries, key=lambda entry : Path(entry.path))
+        for entry in sorted_entries :
+            if entry.is_file() :
+                path_bytes.append(get_stat_bytes(entry.stat()))
+            elif entry.is_dir() :
+                path_bytes.append(get_path_stat_bytes(Path(entry.path)))
+    return b"".join(path_bytes)
 
 def hash_file(hasher : typing.Any, file_path : Path) -> None :
     assert file_path.is_file()
-    file_stat = file_path.stat()
-    hash_float(hasher, file_stat.st_mtime)
-    hash_float(hasher, file_stat.st_ctime)
-    hasher.update(file_stat.st_size.to_bytes(8))
+    hasher.update(get_stat_bytes(file_path.stat()))
 
 def hash_path(hasher : typing.Any, path : Path) -> None :
-    if path.is_file() :
-        hash_file(hasher, path)
-    elif path.is_dir() :
-        path_objects = sorted(path.iterdir())
-        for subpath in path_objects :
-            hash_path(hasher, subpath)
+    hasher.update(key_cache.get_path_bytes(path))
 
 def hash_source(hasher : typing.Any, source_object : typing.Any) -> None :
-    source = getsource(source_object)
-    hash_string(hasher, source)
+    hasher.update(key_cache.get_source_bytes(source_object))
 
 def transaction_hash(index : int, date : str, timestamp : float, delta : float, description : str) -> str :
     hasher = xxh128()
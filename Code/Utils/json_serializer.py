@@ -27,15 +27,17 @@ class __json_serializer :
 			logger.error(f"Failed to serialize {type(something)} : {e}")
 			return "{}"
 
-	def write_to_file(self, file_path : FilePath, something : typing.Any) -> None :
+	def write_to_file(self, file_path : FilePath, something : typing.Any) -> bool :
 		try :
 			with open(file_path, "w", encoding="utf-8-sig") as write_file :
 				if type(something) in self.__writeable_registry :
 					json.dump(something, write_file, default=type(something).encode, indent=2, sort_keys=True)
 				else :
 					json.dump(something, write_file, indent=2, sort_keys=True)
+			return True
 		except Exception as e :
 			logger.error(f"Failed to write {file_path} as {type(something)} : {e}")
+		return False
 
 	def read_from_file(self, file_path : FilePath, read_type : typing.Type = typing.Dict) -> typing.Any :
 		try :
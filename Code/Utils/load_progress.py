@@ -0,0 +1,38 @@
+import typing
+from threading import Event
+
+from Code.Utils.logger import get_logger
+logger = get_logger(__name__)
+
+#stages a ledger build reports, in the order they finish
+imported_stage = "accounts imported"
+derived_stage = "accounts derived"
+validated_stage = "ledger validated"
+
+class LoadCancelled(BaseException) :
+    #not an Exception, so the error handling along the build does not swallow it
+    pass
+
+class LoadProgress :
+
+    #shared between the thread building a ledger and whoever watches it, the build checks for cancellation at every report
+    def __init__(self, callback : typing.Callable[[str, int, int], None] | None = None) :
+        self.__callback = callback
+        self.__cancelled = Event()
+
+    def cancel(self) -> None :
+        self.__cancelled.set()
+
+    def is_cancelled(self) -> bool :
+        return self.__cancelled.is_set()
+
+    def report(self, stage : str, done : int, total : int) -> None :
+        if self.is_cancelled() :
+            logger.info(f"Load cancelled at {stage} ({done}/{total})")
+            raise LoadCancelled(stage)
+        if self.__callback is not None :
+            self.__callback(stage, done, total)
+
+def report_progress(progress : LoadProgress | None, stage : str, done : int, total : int) -> None :
+    if progress is not None :
+        progress.report(stage, done, total)
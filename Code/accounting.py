@@ -10,6 +10,8 @@ from Code.Data.account_data import Account, LedgerImport, AccountMapping
 from Code.Utils.json_serializer import json_serializer
 from Code.string_tree import StringTree, StringDict
 from Code.ledger_database import LedgerDataBase
+from Code.Pipeline.balance_cube import BalanceCube
+from Code.Utils.load_progress import LoadProgress
 
 AccountCache = typing.Dict[str, Account]
 
@@ -25,7 +27,7 @@ def make_category_tree(ledger_db : LedgerDataBase, category_tree_dict : StringDi
 
 class Ledger :
 
-    def __init__(self, data_root_directory : Path, ledger_import : LedgerImport) :
+    def __init__(self, data_root_directory : Path, ledger_import : LedgerImport, progress : LoadProgress | None = None) :
         ledger_data_path = data_root_directory.joinpath(ledger_import.ledger_name)
         if not ledger_data_path.exists() :
             logger.info(f"Creating ledger folder {ledger_data_path}")
@@ -33,24 +35,37 @@ class Ledger :
 
         assert ledger_data_path.exists() or not ledger_data_path.is_dir(), "Expected ledger path not found!"
 
+        #accounting file is read once, the mapping and the category tree both come from it
         account_mapping_file_path = data_root_directory / (ledger_import.accounting_file + ".json")
         if not account_mapping_file_path.exists() :
             json_serializer.write_to_file(account_mapping_file_path, AccountMapping())
-            account_mapping = AccountMapping()
-        else :
-            account_mapping = json_serializer.read_from_file(account_mapping_file_path, AccountMapping)
+        accounting_dict = json_serializer.read_from_file(account_mapping_file_path)
+        account_mapping = AccountMapping.decode(accounting_dict)
 
-        self.__database = LedgerDataBase(data_root_directory, ledger_import, account_mapping)
+        self.__database = LedgerDataBase(data_root_directory, ledger_import, account_mapping, progress)
         logger.info(f"Database created for {ledger_import.ledger_name}")
 
-        account_mapping_file_path = data_root_directory / (ledger_import.accounting_file + ".json")
         category_tree_dict = {}
-        if account_mapping_file_path.exists() :
-            category_tree_dict = json_serializer.read_from_file(account_mapping_file_path)["derived account category tree"]
+        if "derived account category tree" in accounting_dict :
+            category_tree_dict = accounting_dict["derived account category tree"]
         self.category_tree = make_category_tree(self.__database, category_tree_dict)
+        if ledger_import.prefetch :
+            self.__database.start_prefetch()
 
     def get_account(self, account_name : str) -> Account :
         return self.__database.get_account(account_name)
+
+    def get_account_data_table(self, account_name : str) -> DataFrame :
+        return self.__database.get_account_data_table(account_name)
+
+    def get_balance_cube(self) -> BalanceCube :
+        return self.__database.get_balance_cube()
+
+    def get_memory_size(self) -> int :
+        return self.__database.get_memory_size()
+
+    def release_frames(self) -> None :
+        self.__database.release_frames()
     
     def get_source_account_names(self) -> typing.List[str] :
         return self.__database.get_source_account_names()
@@ -1,9 +1,16 @@
+import json
 import typing
+from os import replace as replace_file
+from copy import copy
+from glob import escape as glob_escape
 from pathlib import Path
-from hashlib import sha256
-from polars import DataFrame, read_database
-from sqlalchemy import create_engine, inspect, text
+from xxhash import xxh128
+from polars import DataFrame, Series, read_database, read_parquet, read_ipc
+from polars import String, Float64, Float32, Int64, Int32, UInt32, Boolean, Binary
+from polars._typing import PolarsDataType
+from sqlalchemy import Engine, create_engine, event
 from Code.Utils.json_serializer import json_serializer
+from Code.Data.account_hashing import id_dtype, ids_to_bytes, ids_from_bytes
 
 from Code.Utils.logger import get_logger
 logger = get_logger(__name__)
@@ -11,68 +18,227 @@ logger = get_logger(__name__)
 data_chunk_max = (2 ** 8) * (1024 ** 2)
 
 def get_dataframe_hash(dataframe : DataFrame) -> int :
-    sha256_hasher = sha256()
-    sha256_hasher.update(dataframe.to_pandas().encode('utf-8'))
-    return int(sha256_hasher.hexdigest(), 16)
+    hasher = xxh128()
+    hasher.update(str(dataframe.schema).encode("utf-8"))
+    hasher.update(dataframe.hash_rows().to_numpy().tobytes())
+    return hasher.intdigest()
+
+#sqlite column types for stored frames, the catalog keeps the polars type to restore on read
+sql_column_types : typing.Dict[PolarsDataType, str] = {String : "TEXT", Float64 : "REAL", Float32 : "REAL", Int64 : "INTEGER", Int32 : "INTEGER", UInt32 : "INTEGER", Boolean : "INTEGER", id_dtype : "BLOB"}
+sql_type_names : typing.Dict[str, PolarsDataType] = {str(column_type) : column_type for column_type in sql_column_types}
+sql_indexed_columns = ["ID", "source_ID", "from_transaction_id", "to_transaction_id", "timestamp", "account", "source_account", "from_account_name", "to_account_name"]
+sql_filter_operators = ["=", "!=", "<", "<=", ">", ">=", "in"]
+sql_catalog_name = "frame_catalog"
+
+def quote_sql_name(name : str) -> str :
+    assert "\"" not in name, f"Invalid sql name {name}"
+    return f"\"{name}\""
+
+def enable_sqlite_wal(dbapi_connection : typing.Any, _ : typing.Any) -> None :
+    #readers never block the writer, synchronous normal is durable in wal mode
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+#one pooled engine per database file, shared by every SQLDataBase on it
+sql_engines : typing.Dict[str, Engine] = {}
+
+def get_sql_engine(dbfile_path : Path) -> Engine :
+    uri = f"sqlite:///{str(dbfile_path)}"
+    if uri not in sql_engines :
+        engine = create_engine(uri, pool_size=4, max_overflow=4)
+        event.listen(engine, "connect", enable_sqlite_wal)
+        sql_engines[uri] = engine
+    return sql_engines[uri]
 
 class SQLDataBase :
 
+    #frames as tables in one sqlite file, IDs as 16 byte blobs, with a catalog of stored frames and their types
     def __init__(self, root_path : Path, name : str) :
         self.__dbfile_path = root_path.joinpath(f"{name}.db")
 
         self.URI = f"sqlite:///{str(self.__dbfile_path)}"
-        self.engine = create_engine(self.URI)
+        self.engine = get_sql_engine(self.__dbfile_path)
+        with self.engine.begin() as connection :
+            connection.exec_driver_sql(f"CREATE TABLE IF NOT EXISTS {sql_catalog_name} (name TEXT PRIMARY KEY, schema TEXT NOT NULL)")
+            catalog_rows = connection.exec_driver_sql(f"SELECT name, schema FROM {sql_catalog_name}").all()
+        self.__catalog : typing.Dict[str, typing.List[typing.Tuple[str, str]]] = {row[0] : [tuple(column) for column in json.loads(row[1])] for row in catalog_rows}
+
+    def __get_sql_values(self, series : Series) -> typing.List[typing.Any] :
+        if series.dtype == id_dtype :
+            return ids_to_bytes(series).to_list()
+        return series.to_list()
 
-    def store(self, name : str, dataframe : DataFrame) -> bool :
+    def store(self, name : str, some_object : typing.Any) -> bool :
+        assert not self.is_stored(name), "Dataframe is stored!"
+        return self.__write_frame(name, some_object)
+
+    def update(self, name : str, some_object : typing.Any) -> None :
+        self.__write_frame(name, some_object)
+
+    def __write_frame(self, name : str, some_object : typing.Any) -> bool :
         try :
-            logger.info(not self.is_stored(name), "Dataframe is stored!")
+            frame_attribute = getattr(type(some_object), "frame_attribute", None)
+            dataframe = some_object if frame_attribute is None else getattr(some_object, frame_attribute)
+            assert isinstance(dataframe, DataFrame), f"Cannot store {type(some_object)} as a table!"
             total_memory_needed = dataframe.estimated_size()
             assert total_memory_needed <= data_chunk_max, "Exceeds current allowable dataframe size!"
+            for column_name, column_type in dataframe.schema.items() :
+                assert column_type in sql_column_types, f"Cannot store column {column_name} of type {column_type}!"
 
-            dataframe.write_database(name, self.URI)
+            table_name = quote_sql_name(name)
+            schema = [(column_name, str(column_type)) for column_name, column_type in dataframe.schema.items()]
+            with self.engine.begin() as connection :
+                connection.exec_driver_sql(f"DROP TABLE IF EXISTS {table_name}")
+                if dataframe.width > 0 :
+                    column_definitions = ", ".join(f"{quote_sql_name(column_name)} {sql_column_types[column_type]}" for column_name, column_type in dataframe.schema.items())
+                    connection.exec_driver_sql(f"CREATE TABLE {table_name} ({column_definitions})")
+                    #bulk insert straight from the columns, indexes are built once afterwards
+                    rows = list(zip(*[self.__get_sql_values(dataframe[column_name]) for column_name in dataframe.columns]))
+                    if len(rows) > 0 :
+                        connection.exec_driver_sql(f"INSERT INTO {table_name} VALUES ({', '.join(['?'] * dataframe.width)})", rows)
+                    for column_name in dataframe.columns :
+                        if column_name in sql_indexed_columns :
+                            connection.exec_driver_sql(f"CREATE INDEX {quote_sql_name(f'{name}_{column_name}')} ON {table_name} ({quote_sql_name(column_name)})")
+                connection.exec_driver_sql(f"INSERT OR REPLACE INTO {sql_catalog_name} VALUES (?, ?)", (name, json.dumps(schema)))
+            self.__catalog[name] = schema
             return True
         except Exception as e :
             logger.error(f"Tried to store table {name} to {str(self.__dbfile_path)} but hit :\n{e}")
             return False
-        
-    def update(self, name : str, dataframe : DataFrame) -> None :
-        if self.is_stored(name) :
-            total_memory_needed = dataframe.estimated_size()
-            assert total_memory_needed <= data_chunk_max, "Exceeds current allowable dataframe size!"
-            dataframe.write_database(name, self.URI, if_table_exists="replace")
-        else :
-            self.store(name, dataframe)
-    
-    def query(self, sql_query : str) -> DataFrame :
-        return read_database(sql_query, self.engine)
+
+    def query(self, name : str, filters : typing.List[typing.Tuple[str, str, typing.Any]] = [], columns : typing.List[str] | None = None, order_by : typing.List[str] = []) -> DataFrame :
+        #filters are (column, operator, value) and run in sqlite on bound parameters, ID values are hex strings
+        assert self.is_stored(name), f"Cannot find table {name}"
+        schema = dict(self.__catalog[name])
+        columns = list(schema.keys()) if columns is None else columns
+        if len(columns) == 0 :
+            return DataFrame()
+        for column_name in columns + [f[0] for f in filters] + order_by :
+            assert column_name in schema, f"Unknown column {column_name} in table {name}!"
+
+        conditions = []
+        parameters = []
+        for column_name, operator, value in filters :
+            assert operator in sql_filter_operators, f"Unknown filter operator {operator}, expected one of {sql_filter_operators}"
+            to_sql_value = (lambda v : bytes.fromhex(v)) if schema[column_name] == str(id_dtype) else (lambda v : v)
+            if operator == "in" :
+                values = [to_sql_value(v) for v in value]
+                conditions.append(f"{quote_sql_name(column_name)} IN ({', '.join(['?'] * len(values))})")
+                parameters += values
+            else :
+                conditions.append(f"{quote_sql_name(column_name)} {operator} ?")
+                parameters.append(to_sql_value(value))
+
+        sql_query = f"SELECT {', '.join(quote_sql_name(c) for c in columns)} FROM {quote_sql_name(name)}"
+        if len(conditions) > 0 :
+            sql_query += f" WHERE {' AND '.join(conditions)}"
+        #rowid keeps the stored order unless asked otherwise
+        sql_query += f" ORDER BY {', '.join(quote_sql_name(c) for c in order_by + ['rowid'])}" if len(order_by) > 0 else " ORDER BY rowid"
+
+        read_types : typing.Dict[str, PolarsDataType] = {c : (Binary if schema[c] == str(id_dtype) else sql_type_names[schema[c]]) for c in columns}
+        with self.engine.connect() as connection :
+            dataframe = read_database(sql_query, connection, execute_options={"parameters" : tuple(parameters)}, schema_overrides=read_types)
+        return dataframe.with_columns([ids_from_bytes(dataframe[c]) for c in columns if schema[c] == str(id_dtype)])
 
     def is_stored(self, name : str) -> bool :
-        
-        inspection = inspect(self.engine)
-        return inspection.has_table(name)
+        return name in self.__catalog
 
-    def retrieve(self, name : str) -> DataFrame :
-        assert self.is_stored(name), "Cannot find table {file_path}"
+    def retrieve(self, name : str, object_type : typing.Type = DataFrame) -> typing.Any :
+        assert self.is_stored(name), f"Cannot find table {name}"
         try :
-            dataframe = read_database(f"SELECT * FROM {name}", self.engine)
-            assert dataframe is not None
-            return dataframe
+            dataframe = self.query(name)
+            frame_attribute = getattr(object_type, "frame_attribute", None)
+            if frame_attribute is None :
+                return dataframe
+            some_object = object_type()
+            setattr(some_object, frame_attribute, dataframe)
+            return some_object
         except Exception as e :
             logger.error(f"Tried to get table {name} but hit :\n{e}")
-            return DataFrame()
-    
+            return None
+
+    def get_names(self) -> typing.List[str] :
+        return sorted(self.__catalog.keys())
+
     def drop(self, name : str) -> bool :
         if self.is_stored(name) :
-            with self.engine.connect() as connection :
-                connection.execute(text(f"DROP TABLE {name}"))
-                connection.commit()
+            with self.engine.begin() as connection :
+                connection.exec_driver_sql(f"DROP TABLE IF EXISTS {quote_sql_name(name)}")
+                connection.exec_driver_sql(f"DELETE FROM {sql_catalog_name} WHERE name = ?", (name,))
+            del self.__catalog[name]
             return True
         return False
 
+#objects with a frame_attribute keep only their metadata in json, the frame goes to a sidecar file in the storage format
+class FrameFiles :
+
+    def __init__(self, suffix : str, writer : typing.Callable[[DataFrame, Path], None], reader : typing.Callable[[Path], DataFrame], versioned : bool) :
+        self.suffix = suffix
+        self.__writer = writer
+        self.__reader = reader
+        #versioned files are never overwritten, so readers holding a memory map of an older one stay valid
+        self.__versioned = versioned
+
+    def __get_generation(self, name : str, file_path : Path) -> int | None :
+        generation_name = file_path.name[:-len(self.suffix)]
+        if self.__versioned and generation_name.startswith(f"{name}.") :
+            generation = generation_name[len(name) + 1:]
+            return int(generation) if generation.isdigit() else None
+        return 0 if not self.__versioned and generation_name == name else None
+
+    def __find_generations(self, directory : Path, name : str) -> typing.Dict[int, Path] :
+        #files without a parseable generation are not ours and skipped
+        pattern = f"{glob_escape(name)}.*{self.suffix}" if self.__versioned else f"{glob_escape(name)}{self.suffix}"
+        generations : typing.Dict[int, Path] = {}
+        for file_path in directory.glob(pattern) :
+            generation = self.__get_generation(name, file_path)
+            if generation is not None :
+                generations[generation] = file_path
+        return generations
+
+    def find(self, directory : Path, name : str) -> typing.List[Path] :
+        generations = self.__find_generations(directory, name)
+        return [generations[generation] for generation in sorted(generations.keys())]
+
+    def write(self, directory : Path, name : str, frame : DataFrame) -> None :
+        if self.__versioned :
+            generations = self.__find_generations(directory, name)
+            next_generation = (max(generations.keys()) + 1) if len(generations) > 0 else 0
+            file_path = directory.joinpath(f"{name}.{next_generation}{self.suffix}")
+        else :
+            file_path = directory.joinpath(f"{name}{self.suffix}")
+        temporary_file_path = file_path.with_name(f"{file_path.name}.tmp")
+        self.__writer(frame, temporary_file_path)
+        replace_file(temporary_file_path, file_path)
+        self.remove(directory, name, file_path)
+
+    def read(self, file_path : Path) -> DataFrame :
+        return self.__reader(file_path)
+
+    def remove(self, directory : Path, name : str, keep_file_path : Path | None = None) -> None :
+        for file_path in self.find(directory, name) :
+            if file_path != keep_file_path :
+                try :
+                    file_path.unlink()
+                except OSError as e :
+                    #windows refuses while another reader still maps it, the next write retries
+                    logger.info(f"Could not remove old frame file {file_path} : {e}")
+
+frame_files = {
+    "parquet" : FrameFiles(".parquet", lambda frame, file_path : frame.write_parquet(file_path), read_parquet, False),
+    #uncompressed so reads are a zero copy memory map shared through the page cache with other processes
+    "ipc" : FrameFiles(".arrow", lambda frame, file_path : frame.write_ipc(file_path, compression="uncompressed"), lambda file_path : read_ipc(file_path, memory_map=True), True)
+}
+storage_formats = ["json"] + list(frame_files.keys())
+
 class JsonDataBase :
 
-    def __init__(self, root_path : Path, name : str) :
+    def __init__(self, root_path : Path, name : str, storage_format : str = "json") :
+        assert storage_format in storage_formats, f"Unknown storage format \"{storage_format}\", expected one of {storage_formats}"
         self.__dbfile_path = root_path.joinpath(name)
+        self.__storage_format = storage_format
         if not self.__dbfile_path.exists() :
             self.__dbfile_path.mkdir()
 
@@ -80,14 +246,15 @@ class JsonDataBase :
         assert not self.is_stored(name), "Dataframe is stored!"
         file_path = self.__get_json_file_path(name)
         try :
-            bytestring = json_serializer.write_to_string(some_object).encode("utf-8")
+            metadata_object, frame = self.__split_frame(some_object)
+            bytestring = json_serializer.write_to_string(metadata_object).encode("utf-8")
             
-            total_memory_needed = len(bytestring)
+            total_memory_needed = len(bytestring) + (0 if frame is None else frame.estimated_size())
             assert total_memory_needed <= data_chunk_max, "Exceeds current allowable dataframe size!"
 
             with open(file_path, 'x') as _ :
                 pass
-            json_serializer.write_to_file(file_path, some_object)
+            self.__write_object(name, metadata_object, frame)
             return True
         except Exception as e :
             logger.error(f"Tried to store file {file_path} but hit :\n{e}")
@@ -95,14 +262,40 @@ class JsonDataBase :
         
     def update(self, name : str, some_object : typing.Any) -> None :
         if self.is_stored(name) :
-            file_path = self.__get_json_file_path(name)
-            json_serializer.write_to_file(file_path, some_object)
+            metadata_object, frame = self.__split_frame(some_object)
+            self.__write_object(name, metadata_object, frame)
         else :
             self.store(name, some_object)
 
+    def __split_frame(self, some_object : typing.Any) -> typing.Tuple[typing.Any, DataFrame | None] :
+        frame_attribute = getattr(type(some_object), "frame_attribute", None)
+        if self.__storage_format == "json" or frame_attribute is None :
+            return some_object, None
+        metadata_object = copy(some_object)
+        setattr(metadata_object, frame_attribute, DataFrame())
+        return metadata_object, getattr(some_object, frame_attribute)
+
+    def __write_object(self, name : str, metadata_object : typing.Any, frame : DataFrame | None) -> None :
+        for storage_format, files in frame_files.items() :
+            if frame is not None and storage_format == self.__storage_format :
+                files.write(self.__dbfile_path, name, frame)
+            else :
+                files.remove(self.__dbfile_path, name)
+        file_path = self.__get_json_file_path(name)
+        temporary_file_path = file_path.with_name(f"{file_path.name}.tmp")
+        if json_serializer.write_to_file(temporary_file_path, metadata_object) :
+            replace_file(temporary_file_path, file_path)
+
     def is_stored(self, name : str) -> bool :
         file_path = self.__get_json_file_path(name)
         return file_path.exists() and file_path.is_file()
+
+    def get_modified_stamp(self, name : str) -> typing.Tuple[int, int] | None :
+        try :
+            file_stat = self.__get_json_file_path(name).stat()
+            return (file_stat.st_mtime_ns, file_stat.st_size)
+        except FileNotFoundError :
+            return None
     
     def __get_json_file_path(self, name : str) -> Path :
         return self.__dbfile_path.joinpath(f"{name}.json")
@@ -112,6 +305,13 @@ class JsonDataBase :
         try :
             file_path = self.__get_json_file_path(name)
             some_object = json_serializer.read_from_file(file_path, object_type)
+            frame_attribute = getattr(object_type, "frame_attribute", None)
+            if some_object is not None and frame_attribute is not None :
+                #any sidecar is read regardless of current format, json only objects keep their inline frame
+                for files in frame_files.values() :
+                    frame_file_paths = files.find(self.__dbfile_path, name)
+                    if len(frame_file_paths) > 0 :
+                        setattr(some_object, frame_attribute, files.read(frame_file_paths[-1]))
             return some_object
         except Exception as e :
             logger.error(f"Tried to get file {file_path} but hit :\n{e}")
@@ -122,7 +322,7 @@ class JsonDataBase :
         for folder_entry in self.__dbfile_path.iterdir() :
             if folder_entry.is_file() and folder_entry.suffix == ".json" :
                 name_list.append(folder_entry.stem)
-            else :
+            elif not (folder_entry.is_file() and folder_entry.suffix in [files.suffix for files in frame_files.values()]) :
                 logger.info(f"Found non-database folder entry \"{folder_entry}\"")
         return sorted(name_list)
     
@@ -130,5 +330,18 @@ class JsonDataBase :
         if self.is_stored(name) :
             file_path = self.__get_json_file_path(name)
             file_path.unlink()
+            for files in frame_files.values() :
+                files.remove(self.__dbfile_path, name)
             return True
         return False
+
+    def convert_storage(self, object_type : typing.Type, names : typing.List[str] | None = None) -> int :
+        converted_count = 0
+        for name in (self.get_names() if names is None else names) :
+            if self.is_stored(name) :
+                some_object = self.retrieve(name, object_type)
+                if some_object is not None :
+                    self.update(name, some_object)
+                    converted_count += 1
+        logger.info(f"Converted {converted_count} objects in {self.__dbfile_path} to {self.__storage_format}")
+        return converted_count
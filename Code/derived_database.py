@@ -4,35 +4,65 @@ from pathlib import Path
 from Code.database import JsonDataBase
 from Code.object_cacher import ObjectCacher
 from Code.source_database import SourceDataBase
-from Code.Data.account_data import Account, DerivedAccount
-from Code.Pipeline.account_derivation import get_derived_account, get_derived_account_hash
+from Code.Data.account_data import Account, DerivedAccount, DerivationManifest
+from Code.Pipeline.account_derivation import update_derived_account, get_derived_account_hash
+from Code.Pipeline.transaction_classification import TransactionClassifier, get_transactions_fingerprint
+from Code.Utils.load_progress import LoadProgress, report_progress, derived_stage
 
 from Code.Utils.logger import get_logger
 logger = get_logger(__name__)
 
 class DerivedDataBase(JsonDataBase) :
-    
-    def __init__(self, hash_db : JsonDataBase, source_db : SourceDataBase, ledger_output_path : Path, account_derivations : typing.List[DerivedAccount]) :
-        super().__init__(ledger_output_path, "DerivedAccounts")
+
+    database_name = "DerivedAccounts"
+    manifest_database_name = "DerivationManifests"
+
+    def __init__(self, hash_db : JsonDataBase, source_db : SourceDataBase, ledger_output_path : Path, account_derivations : typing.List[DerivedAccount], storage_format : str = "json", classifier : TransactionClassifier | None = None, eager : bool = True, progress : LoadProgress | None = None) :
+        super().__init__(ledger_output_path, DerivedDataBase.database_name, storage_format)
         self.__cache = ObjectCacher(hash_db, "DerivedAccountHashes", Account())
+        self.__manifest_db = JsonDataBase(ledger_output_path, DerivedDataBase.manifest_database_name)
         self.__derived_data_lookup = {}
         self.__source_db = source_db
+        self.__classifier = classifier
 
         for account_derivation in account_derivations :
             self.__derived_data_lookup[account_derivation.name] = account_derivation
-        for account_derivation in account_derivations :
+        if not eager :
+            #accounts are derived on first request
+            report_progress(progress, derived_stage, len(account_derivations), len(account_derivations))
+            return
+        report_progress(progress, derived_stage, 0, len(account_derivations))
+        for index, account_derivation in enumerate(account_derivations) :
             self.get_account(account_derivation.name)
+            report_progress(progress, derived_stage, index + 1, len(account_derivations))
+        self.flush()
 
     def __derive_account(self, account_name : str) -> Account | None :
         account_derivation = self.__derived_data_lookup[account_name]
-        account = get_derived_account(self.__source_db, account_derivation)
+        stored_account = self.retrieve(account_name, Account) if self.is_stored(account_name) else None
+        manifest = self.__manifest_db.retrieve(account_name, DerivationManifest) if self.__manifest_db.is_stored(account_name) else None
+        account, manifest = update_derived_account(self.__source_db, account_derivation, stored_account, manifest or DerivationManifest(), self.__classifier)
+        manifest.fingerprint = get_transactions_fingerprint(account).hex()
+        #manifest goes first, if the account write is lost the manifest no longer matches and the next derivation is a full one
+        self.__manifest_db.update(account_name, manifest)
         logger.info(f"Derived account {account_name}!")
         return account
     
+    def flush(self) -> None :
+        self.__cache.flush()
+
+    def get_account_names(self) -> typing.List[str] :
+        #configured accounts, whether derived yet or not
+        return sorted(self.__derived_data_lookup.keys())
+
     def get_account_hash(self, account_name : str) -> str :
         account_derivation = self.__derived_data_lookup[account_name]
         return get_derived_account_hash(self.__source_db, account_derivation)
 
+    def get_stored_account_hash(self, account_name : str) -> str :
+        #hash the stored account was built at, "0" if never built
+        return self.__cache.get_stored_hash(account_name)
+
     def get_account(self, account_name : str) -> Account :
         if account_name not in self.__derived_data_lookup :
             logger.info(f"Account {account_name} not found in derivation data!")
@@ -40,3 +70,13 @@ class DerivedDataBase(JsonDataBase) :
 
         current_hash = self.get_account_hash(account_name)
         return self.__cache.request_object(self, account_name, current_hash, self.__derive_account)
+
+    def get_account_fingerprint(self, account_name : str) -> bytes :
+        #identifies the stored rows themselves, the same inputs can be derived into different IDs
+        #recorded in the manifest when derived, so an account already up to date is never loaded for it
+        is_current = account_name in self.__derived_data_lookup and self.is_stored(account_name) and self.__cache.get_stored_hash(account_name) == self.get_account_hash(account_name)
+        if is_current and self.__manifest_db.is_stored(account_name) :
+            manifest = self.__manifest_db.retrieve(account_name, DerivationManifest)
+            if manifest is not None and manifest.fingerprint != "0" :
+                return bytes.fromhex(manifest.fingerprint)
+        return get_transactions_fingerprint(self.get_account(account_name))
@@ -1,14 +1,16 @@
 import typing
 from pathlib import Path
+from threading import Thread, Event, RLock
 from numpy import repeat
-from polars import DataFrame, Series
+from polars import DataFrame, Series, Float64
 from polars import concat
 
 from Code.Utils.logger import get_logger
 logger = get_logger(__name__)
 
-from Code.Pipeline.ledger_validation import get_ledger_entries_hash, get_ledger_entries
-from Code.Pipeline.ledger_validation import get_unaccounted_transactions_hash, get_unaccounted_transactions
+from Code.Pipeline.ledger_validation import make_ledger_build_graph, ledger_entries_node, unaccounted_transactions_node, balance_cube_node
+from Code.Pipeline.balance_cube import BalanceCube
+from Code.Pipeline.transaction_classification import TransactionClassifier
 
 from Code.Data.account_data import Account
 from Code.Data.account_data import LedgerConfiguration, AccountMapping, LedgerImport
@@ -17,18 +19,29 @@ from Code.Data.account_data import DataFrameObject
 from Code.source_database import SourceDataBase
 from Code.derived_database import DerivedDataBase
 from Code.object_cacher import ObjectCacher
-from Code.database import JsonDataBase
+from Code.database import JsonDataBase, SQLDataBase
 from Code.Utils.json_serializer import json_serializer
+from Code.Utils.hashing import key_cache
+from Code.Utils.load_progress import LoadProgress, report_progress, validated_stage
+
+account_data_table_columns = ["date", "description", "delta", "balance"]
 
 def make_account_data_table(account : Account) -> DataFrame :
     account_data = account.transactions[["date", "description", "delta"]]
-    balance_list = []
-    current_balance = account.start_value
-    for transaction in account.transactions.rows() :
-        current_balance += transaction[2]
-        balance_list.append(round(current_balance, 2))
-    balance_frame = DataFrame(Series("balance", balance_list))
-    return concat([account_data, balance_frame], how="horizontal")
+    #start value leads the sum, so the balances add up in the same order as one by one
+    #halves round away from zero, unlike python round, so the balances match one by one only for whole cent deltas
+    balances = concat([Series([account.start_value], dtype=Float64), account_data["delta"].cast(Float64)]).cum_sum().slice(1).round(2)
+    return account_data.with_columns(balances.alias("balance"))
+
+def convert_ledger_storage(root_path : Path, ledger_import : LedgerImport, storage_format : str) -> None :
+    ledger_output_path = root_path / ledger_import.ledger_name
+    for database_name in [SourceDataBase.database_name, DerivedDataBase.database_name] :
+        JsonDataBase(ledger_output_path, database_name, storage_format).convert_storage(Account)
+    config_db = JsonDataBase(ledger_output_path, LedgerDataBase.config_name, storage_format)
+    config_db.convert_storage(DataFrameObject, [LedgerDataBase.entries_name, LedgerDataBase.unaccounted_name, LedgerDataBase.balance_cube_name])
+    JsonDataBase(ledger_output_path, LedgerDataBase.fragment_database_name, storage_format).convert_storage(DataFrameObject)
+    JsonDataBase(ledger_output_path, LedgerDataBase.account_table_database_name, storage_format).convert_storage(DataFrameObject)
+    JsonDataBase(ledger_output_path, LedgerDataBase.match_database_name, storage_format).convert_storage(DataFrameObject)
 
 def get_ledger_configuration(dataroot_path : Path) -> LedgerConfiguration :
     ledger_config_path = dataroot_path / "LedgerConfiguration.json"
@@ -42,20 +55,59 @@ def get_ledger_configuration(dataroot_path : Path) -> LedgerConfiguration :
 
 class LedgerDataBase :
 
-    unaccounted_name = "UnaccountedTransactions"
-    entries_name = "LedgerEntries"
+    unaccounted_name = unaccounted_transactions_node
+    balance_cube_name = balance_cube_node
+    entries_name = ledger_entries_node
+    config_name = "Config"
+    table_database_name = "Ledger"
+    fragment_database_name = "LedgerFragments"
+    account_table_database_name = "AccountTables"
+    match_database_name = "MatchResults"
+    #ledger tables go next to the hash manifests in the config database, or into one sqlite file per ledger
+    table_databases = ["config", "sqlite"]
 
-    def __init__(self, root_path : Path, ledger_import : LedgerImport, account_mapping : AccountMapping) :
+    def __init__(self, root_path : Path, ledger_import : LedgerImport, account_mapping : AccountMapping, progress : LoadProgress | None = None) :
         ledger_output_path = root_path / ledger_import.ledger_name
         name = ledger_import.ledger_name
-        self.__config_db = JsonDataBase(ledger_output_path, "Config")
+        self.__name = name
+        #one request at a time, the prefetcher takes it per item so requests get in between
+        self.__lock = RLock()
+        self.__prefetch_thread : Thread | None = None
+        self.__prefetch_stop = Event()
+        eager = not ledger_import.lazy_loading
+        key_cache.begin_session()
+        self.__config_db = JsonDataBase(ledger_output_path, LedgerDataBase.config_name, ledger_import.storage_format)
         self.__cache = ObjectCacher(self.__config_db, "LedgerDataHashes", DataFrameObject())
+        assert ledger_import.table_database in LedgerDataBase.table_databases, f"Unknown table database \"{ledger_import.table_database}\", expected one of {LedgerDataBase.table_databases}"
+        self.__table_db : JsonDataBase | SQLDataBase = self.__config_db if ledger_import.table_database == "config" else SQLDataBase(ledger_output_path, LedgerDataBase.table_database_name)
+        #per node pieces of the ledger tables, a change only rebuilds the fragments downstream of it
+        self.__fragment_cache = ObjectCacher(self.__config_db, "LedgerFragmentHashes", DataFrameObject())
+        self.__fragment_db : JsonDataBase | SQLDataBase
+        if ledger_import.table_database == "config" :
+            self.__fragment_db = JsonDataBase(ledger_output_path, LedgerDataBase.fragment_database_name, ledger_import.storage_format)
+        else :
+            self.__fragment_db = SQLDataBase(ledger_output_path, LedgerDataBase.fragment_database_name)
+        #display tables of accounts, kept under the hash their account was built at
+        self.__account_table_cache = ObjectCacher(self.__config_db, "AccountTableHashes", DataFrameObject())
+        self.__account_table_db : JsonDataBase | SQLDataBase
+        if ledger_import.table_database == "config" :
+            self.__account_table_db = JsonDataBase(ledger_output_path, LedgerDataBase.account_table_database_name, ledger_import.storage_format)
+        else :
+            self.__account_table_db = SQLDataBase(ledger_output_path, LedgerDataBase.account_table_database_name)
         self.__account_mapping = account_mapping
+        #ledger tables last served and their keys, released when memory is needed elsewhere
+        self.__resident_tables : typing.Dict[str, typing.Tuple[str, DataFrame]] = {}
+        #display tables of accounts viewed and their account hashes
+        self.__account_data_tables : typing.Dict[str, typing.Tuple[str, DataFrame]] = {}
+        #cube over the resident cube table it was made from
+        self.__balance_cube : typing.Tuple[DataFrame, BalanceCube] | None = None
+        #shared so each source account is labelled once for all derivations and ledger tables
+        self.__classifier = TransactionClassifier(account_mapping, JsonDataBase(ledger_output_path, LedgerDataBase.match_database_name, ledger_import.storage_format), self.__config_db)
 
         try :
             logger.info(f"Creating source database for {name}")
             account_data_path = root_path / ledger_import.source_account_folder
-            source_db = SourceDataBase(self.__config_db, ledger_output_path, ledger_import.raw_accounts, account_data_path)
+            source_db = SourceDataBase(self.__config_db, ledger_output_path, ledger_import.raw_accounts, account_data_path, ledger_import.storage_format, ledger_import.import_workers, ledger_import.import_processes, eager, progress)
             logger.info(f"Source database created for {name}")
             self.__source_db = source_db
         except Exception as e :
@@ -63,53 +115,176 @@ class LedgerDataBase :
 
         try :
             logger.info(f"Creating derived database for {name}")
-            derived_db = DerivedDataBase(self.__config_db, self.__source_db, ledger_output_path, account_mapping.derived_accounts)
+            derived_db = DerivedDataBase(self.__config_db, self.__source_db, ledger_output_path, account_mapping.derived_accounts, ledger_import.storage_format, self.__classifier, eager, progress)
             logger.info(f"Derived database created for {name}")
             self.__derived_db = derived_db
         except Exception as e :
             logger.error(f"Failed to build derived database for ledger {name}! {e}")
 
+        self.__build_graph = make_ledger_build_graph(account_mapping, self.__source_db, self.__derived_db)
+        if not eager :
+            logger.info(f"Ledger {name} opened lazily, accounts and tables are built on first request")
+            report_progress(progress, validated_stage, 2, 2)
+            return
+        report_progress(progress, validated_stage, 0, 2)
         self.get_ledger_entries_table()
+        report_progress(progress, validated_stage, 1, 2)
         self.get_unaccounted_transaction_table()
+        report_progress(progress, validated_stage, 2, 2)
+        self.__drop_stale_fragments()
+        self.flush()
+        logger.info(f"Cache key memo hits and misses for {name} : {key_cache.get_stats()}")
+
+    def __prefetch(self) -> None :
+        #source accounts first, everything else is built from them, the ledger tables last
+        names : typing.List[typing.Tuple[typing.Callable[[str], typing.Any], str]] = [(self.get_account, account_name) for account_name in self.get_source_account_names()]
+        names += [(self.get_account, account_name) for account_name in self.get_derived_account_names()]
+        names += [(self.get_ledger_table, LedgerDataBase.entries_name), (self.get_ledger_table, LedgerDataBase.unaccounted_name), (self.get_ledger_table, LedgerDataBase.balance_cube_name)]
+        for getter, name in names :
+            if self.__prefetch_stop.is_set() :
+                logger.info(f"Prefetch of {self.__name} stopped")
+                return
+            try :
+                getter(name)
+            except Exception as e :
+                logger.error(f"Failed to prefetch {name} of {self.__name}! {e}")
+        with self.__lock :
+            self.__drop_stale_fragments()
+            self.flush()
+        logger.info(f"Prefetch of {self.__name} done")
+
+    def start_prefetch(self) -> None :
+        if self.__prefetch_thread is not None and self.__prefetch_thread.is_alive() :
+            return
+        self.__prefetch_stop.clear()
+        self.__prefetch_thread = Thread(target=self.__prefetch, name=f"Prefetch {self.__name}", daemon=True)
+        self.__prefetch_thread.start()
+
+    def stop_prefetch(self) -> None :
+        self.__prefetch_stop.set()
+        self.wait_prefetch()
+
+    def wait_prefetch(self, timeout : float | None = None) -> bool :
+        #true once no prefetch is running
+        if self.__prefetch_thread is not None :
+            self.__prefetch_thread.join(timeout)
+            return not self.__prefetch_thread.is_alive()
+        return True
+
+    def flush(self) -> None :
+        #hash manifests are written behind, once per build rather than once per object
+        self.__source_db.flush()
+        self.__derived_db.flush()
+        self.__fragment_cache.flush()
+        self.__account_table_cache.flush()
+        self.__classifier.flush()
+        self.__cache.flush()
 
     def account_is_created(self, account_name : str) -> bool :
-        return self.__source_db.is_stored(account_name) != self.__derived_db.is_stored(account_name)
+        #configured accounts count, lazily opened ledgers have not built them yet
+        return (account_name in self.get_source_account_names()) != (account_name in self.get_derived_account_names())
+
+    def __get_account_database(self, account_name : str) -> SourceDataBase | DerivedDataBase :
+        if account_name in self.get_source_account_names() :
+            return self.__source_db
+        assert account_name in self.get_derived_account_names(), f"Account {account_name} is not in base or derived DBs?"
+        return self.__derived_db
 
     def get_account(self, account_name : str) -> Account :
-        if self.__source_db.is_stored(account_name) :
-            return self.__source_db.get_account(account_name)
-        else :
-            assert self.__derived_db.is_stored(account_name), f"Account {account_name} is not in base or derived DBs?"
-            return self.__derived_db.get_account(account_name)
+        #each request rescans the source folders once, so files changed since the build are still picked up
+        with self.__lock :
+            key_cache.begin_session()
+            account = self.__get_account_database(account_name).get_account(account_name)
+            self.flush()
+            return account
     
+    def get_account_data_table(self, account_name : str) -> DataFrame :
+        #the table only shows rows of the account, so the hash of its inputs keys it and a hit never loads the account
+        with self.__lock :
+            key_cache.begin_session()
+            account_db = self.__get_account_database(account_name)
+            account_hash = account_db.get_account_hash(account_name)
+            if account_name in self.__account_data_tables and self.__account_data_tables[account_name][0] == account_hash :
+                return self.__account_data_tables[account_name][1]
+            if self.__account_table_cache.get_stored_hash(account_name) == account_hash and self.__account_table_db.is_stored(account_name) :
+                table = self.__account_table_db.retrieve(account_name, DataFrameObject).frame.select(account_data_table_columns)
+            else :
+                table = make_account_data_table(self.get_account(account_name))
+                #a failed build serves an empty account, that table is not kept
+                if account_db.get_stored_account_hash(account_name) == account_hash :
+                    self.__account_table_cache.store_object(self.__account_table_db, account_name, account_hash, DataFrameObject(table))
+                    self.flush()
+            self.__account_data_tables[account_name] = (account_hash, table)
+            return table
+
     def get_source_account_names(self) -> typing.List[str] :
-        return self.__source_db.get_names()
+        return self.__source_db.get_account_names()
     
     def get_derived_account_names(self) -> typing.List[str] :
-        return self.__derived_db.get_names()
+        return self.__derived_db.get_account_names()
+
+    def __get_node_value(self, name : str) -> typing.Any :
+        if self.__build_graph.get_node(name).is_leaf() :
+            return self.__build_graph.get_leaf_value(name)
+        return self.__fragment_cache.request_object(self.__fragment_db, name, self.__build_graph.get_key(name), self.get_ledger_data).frame
+
+    def __drop_stale_fragments(self) -> None :
+        built_names = set(self.__build_graph.get_built_names())
+        for name in self.__fragment_db.get_names() :
+            if name not in built_names :
+                logger.info(f"Dropping ledger fragment {name}, no longer in the build graph")
+                self.__fragment_cache.drop_object(self.__fragment_db, name)
 
     def get_ledger_data(self, name : str) -> DataFrameObject :
-        match name :
-            case LedgerDataBase.unaccounted_name :
-                df = get_unaccounted_transactions(self.__account_mapping, self.__source_db)
-            case LedgerDataBase.entries_name :
-                df = get_ledger_entries(self.__account_mapping, self.__source_db)
-            case _ :
-                df = DataFrame()
+        if self.__build_graph.has_node(name) :
+            df = self.__build_graph.build(name, self.__get_node_value, self.__classifier)
+        else :
+            df = DataFrame()
         return DataFrameObject(df)
 
+    def get_ledger_table(self, name : str) -> DataFrame :
+        with self.__lock :
+            key_cache.begin_session()
+            self.__build_graph.begin_session()
+            table_hash = self.__build_graph.get_key(name)
+            if name in self.__resident_tables and self.__resident_tables[name][0] == table_hash :
+                return self.__resident_tables[name][1]
+            table = self.__cache.request_object(self.__table_db, name, table_hash, self.get_ledger_data).frame
+            self.__resident_tables[name] = (table_hash, table)
+            self.flush()
+            return table
+
+    def get_memory_size(self) -> int :
+        with self.__lock :
+            resident_tables = list(self.__resident_tables.values()) + list(self.__account_data_tables.values())
+            return sum(int(table.estimated_size()) for _, table in resident_tables) + self.__classifier.get_memory_size()
+
+    def release_frames(self) -> None :
+        #manifests, the build graph and configuration stay, so the ledger reopens without a rebuild
+        with self.__lock :
+            self.__resident_tables.clear()
+            self.__account_data_tables.clear()
+            self.__balance_cube = None
+            self.__classifier.release()
+
     def get_ledger_entries_table(self) -> DataFrame :
         try :
-            ledger_entries_hash = get_ledger_entries_hash(self.__account_mapping, self.__source_db)
-            return self.__cache.request_object(self.__config_db, LedgerDataBase.entries_name, ledger_entries_hash, self.get_ledger_data).frame
+            return self.get_ledger_table(LedgerDataBase.entries_name)
         except Exception as e :
             logger.error(f"Failed to verify ledger entries! {e}")
         return DataFrame()
 
+    def get_balance_cube(self) -> BalanceCube :
+        #built once per ledger version, the table key covers every source and derived account
+        with self.__lock :
+            cube_table = self.get_ledger_table(LedgerDataBase.balance_cube_name)
+            if self.__balance_cube is None or self.__balance_cube[0] is not cube_table :
+                self.__balance_cube = (cube_table, BalanceCube(cube_table))
+            return self.__balance_cube[1]
+
     def get_unaccounted_transaction_table(self) -> DataFrame :
         try:
-            unaccounted_transactions_hash = get_unaccounted_transactions_hash(self.__account_mapping, self.__source_db)
-            return self.__cache.request_object(self.__config_db, LedgerDataBase.unaccounted_name, unaccounted_transactions_hash, self.get_ledger_data).frame
+            return self.get_ledger_table(LedgerDataBase.unaccounted_name)
         except Exception as e :
             logger.error(f"Failed to calculate unaccounted transactions! {e}")
         return DataFrame()
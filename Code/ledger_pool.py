@@ -0,0 +1,59 @@
+import typing
+from collections import OrderedDict
+from threading import RLock
+
+from Code.Utils.logger import get_logger
+logger = get_logger(__name__)
+
+from Code.accounting import Ledger
+
+bytes_per_megabyte = 1024 ** 2
+
+class LedgerPool :
+
+    #ledgers stay open once loaded, over budget the frames of the least recently viewed are released
+    #the ledger viewed last keeps its frames whatever they cost
+    def __init__(self, memory_budget_megabytes : int = 0) :
+        self.__ledgers : typing.OrderedDict[str, Ledger] = OrderedDict()
+        self.__memory_budget = memory_budget_megabytes * bytes_per_megabyte
+        self.__lock = RLock()
+
+    def __contains__(self, ledger_name : str) -> bool :
+        with self.__lock :
+            return ledger_name in self.__ledgers
+
+    def get_names(self) -> typing.List[str] :
+        with self.__lock :
+            return list(self.__ledgers.keys())
+
+    def add(self, ledger_name : str, ledger : Ledger) -> None :
+        with self.__lock :
+            self.__ledgers[ledger_name] = ledger
+            #added in the background, not viewed yet
+            self.__ledgers.move_to_end(ledger_name, last=False)
+        self.trim()
+
+    def get(self, ledger_name : str) -> Ledger :
+        with self.__lock :
+            self.__ledgers.move_to_end(ledger_name)
+            ledger = self.__ledgers[ledger_name]
+        self.trim()
+        return ledger
+
+    def get_memory_size(self) -> int :
+        with self.__lock :
+            return sum(ledger.get_memory_size() for ledger in self.__ledgers.values())
+
+    def trim(self) -> None :
+        if self.__memory_budget <= 0 :
+            return
+        with self.__lock :
+            ledger_sizes = {name : ledger.get_memory_size() for name, ledger in self.__ledgers.items()}
+            memory_size = sum(ledger_sizes.values())
+            for name in list(self.__ledgers.keys())[:-1] :
+                if memory_size <= self.__memory_budget :
+                    break
+                if ledger_sizes[name] > 0 :
+                    logger.info(f"Releasing frames of ledger {name}, {memory_size} bytes held over a budget of {self.__memory_budget}")
+                    self.__ledgers[name].release_frames()
+                    memory_size -= ledger_sizes[name]
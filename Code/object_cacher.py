@@ -1,5 +1,5 @@
 import typing
-from Code.database import JsonDataBase
+from Code.database import JsonDataBase, SQLDataBase
 
 from Code.Utils.logger import get_logger
 logger = get_logger(__name__)
@@ -11,39 +11,82 @@ class ObjectCacher :
         self.__hash_object_name = hash_object_name
         self.__default_object = default_object
         self.__default_object_type = type(default_object)
-        
-    def __get_stored_hashes(self) :
-        if self.__hash_db.is_stored(self.__hash_object_name) :
-            return self.__hash_db.retrieve(self.__hash_object_name)
-        else :
-            self.__hash_db.store(self.__hash_object_name, {})
-            return {}
+
+        #manifest is kept in memory, changed names are written behind in one go on flush
+        self.__stored_hashes : typing.Dict[str, str] = {}
+        self.__dirty_names : typing.Set[str] = set()
+        self.__manifest_stamp : typing.Tuple[int, int] | None = None
+        self.__manifest_loaded = False
+
+    def __get_stored_hashes(self) -> typing.Dict[str, str] :
+        current_stamp = self.__hash_db.get_modified_stamp(self.__hash_object_name)
+        if not self.__manifest_loaded or current_stamp != self.__manifest_stamp :
+            self.__reload_stored_hashes(current_stamp)
+        return self.__stored_hashes
+
+    def __reload_stored_hashes(self, current_stamp : typing.Tuple[int, int] | None) -> None :
+        if self.__manifest_loaded :
+            logger.info(f"Hash manifest {self.__hash_object_name} changed on disk, reloading")
+        stored_hashes = {}
+        if current_stamp is not None :
+            stored_hashes = self.__hash_db.retrieve(self.__hash_object_name)
+            if stored_hashes is None :
+                logger.warning(f"Could not read hash manifest {self.__hash_object_name}, treating as empty")
+                stored_hashes = {}
+        #pending changes win over the external edit
+        for name in self.__dirty_names :
+            if name in self.__stored_hashes :
+                stored_hashes[name] = self.__stored_hashes[name]
+            elif name in stored_hashes :
+                del stored_hashes[name]
+        self.__stored_hashes = stored_hashes
+        self.__manifest_stamp = current_stamp
+        self.__manifest_loaded = True
 
     def get_stored_hash(self, name : str) -> str :
         source_hashes = self.__get_stored_hashes()
         if name in source_hashes :
             stored_hash = source_hashes[name]
-            assert stored_hash != 0, "Stored 0 hashes forbidden, means import never done or invalid!"
+            assert stored_hash != "0", "Stored 0 hashes forbidden, means import never done or invalid!"
             return stored_hash
         else :
             return "0"
 
     def set_stored_hash(self, name : str, new_hash : str) -> None :
-        assert self.get_stored_hash(name) != new_hash, "Setting new hash without checking it?"
         source_hashes = self.__get_stored_hashes()
-        if new_hash != 0 :
+        assert source_hashes.get(name, "0") != new_hash, "Setting new hash without checking it?"
+        #"0" is no hash, the entry is removed
+        if new_hash != "0" :
             source_hashes[name] = new_hash
         else :
             if name in source_hashes :
                 del source_hashes[name]
             else :
                 logger.info("Zeroing out hash, something destructive or erroneous happened!")
+        self.__dirty_names.add(name)
+
+    def is_dirty(self) -> bool :
+        return len(self.__dirty_names) > 0
+
+    def flush(self) -> None :
+        if not self.is_dirty() :
+            return
+        source_hashes = self.__get_stored_hashes()
         self.__hash_db.update(self.__hash_object_name, source_hashes)
+        logger.info(f"Flushed {len(self.__dirty_names)} hashes to {self.__hash_object_name}")
+        self.__dirty_names.clear()
+        self.__manifest_stamp = self.__hash_db.get_modified_stamp(self.__hash_object_name)
 
-    def request_object(self, cache_db : JsonDataBase, object_name : str, current_hash : str, generator : typing.Callable) -> typing.Any :
+    def store_object(self, cache_db : JsonDataBase | SQLDataBase, object_name : str, current_hash : str, stored_object : typing.Any) -> None :
+        #object is written first, a hash lost before flush only costs a rebuild
+        cache_db.update(object_name, stored_object)
+        if self.get_stored_hash(object_name) != current_hash :
+            self.set_stored_hash(object_name, current_hash)
+
+    def request_object(self, cache_db : JsonDataBase | SQLDataBase, object_name : str, current_hash : str, generator : typing.Callable) -> typing.Any :
         result_hash = current_hash
         stored_hash = self.get_stored_hash(object_name)
-        if stored_hash == result_hash :
+        if stored_hash == result_hash and cache_db.is_stored(object_name) :
             #hash same, no action
             return cache_db.retrieve(object_name, self.__default_object_type)
 
@@ -54,8 +97,12 @@ class ObjectCacher :
             logger.error(f"Failed to generate object {object_name}! {e}")
             return self.__default_object
         if isinstance(requested_object, self.__default_object_type) :
-            self.set_stored_hash(object_name, result_hash)
-            cache_db.update(object_name, requested_object)
+            self.store_object(cache_db, object_name, result_hash, requested_object)
             return requested_object
         logger.warning(f"Object {object_name} not expected type, returning default")
         return self.__default_object
+
+    def drop_object(self, cache_db : JsonDataBase | SQLDataBase, object_name : str) -> None :
+        cache_db.drop(object_name)
+        if self.get_stored_hash(object_name) != "0" :
+            self.set_stored_hash(object_name, "0")
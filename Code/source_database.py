@@ -1,37 +1,114 @@
 import typing
 from pathlib import Path
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
 
 from Code.database import JsonDataBase
 from Code.object_cacher import ObjectCacher
-from Code.Data.account_data import Account, AccountImport
-from Code.Pipeline.account_importing import get_imported_account, get_imported_account_hash
+from Code.Data.account_data import Account, AccountImport, ImportManifest
+from Code.Pipeline.account_importing import update_imported_account, get_imported_account_hash, get_import_worker_count
+from Code.Pipeline.transaction_classification import get_transactions_fingerprint
+from Code.Utils.load_progress import LoadProgress, report_progress, imported_stage
 
 from Code.Utils.logger import get_logger
 logger = get_logger(__name__)
 
+def import_stored_account(account_db : JsonDataBase, manifest_db : JsonDataBase, account_data_path : Path, account_import : AccountImport, import_workers : int) -> typing.Tuple[Account, ImportManifest] :
+    account_name = account_import.account_name
+    stored_account = account_db.retrieve(account_name, Account) if account_db.is_stored(account_name) else None
+    manifest = manifest_db.retrieve(account_name, ImportManifest) if manifest_db.is_stored(account_name) else None
+    return update_imported_account(account_name, account_data_path / account_name, account_import.opening_balance, stored_account, manifest or ImportManifest(), import_workers)
+
+def import_stored_account_process(ledger_output_path : Path, storage_format : str, account_data_path : Path, account_import : AccountImport) -> typing.Tuple[Account, ImportManifest] :
+    #runs in a pool process, only reads the databases, the parent commits the results
+    account_db = JsonDataBase(ledger_output_path, SourceDataBase.database_name, storage_format)
+    manifest_db = JsonDataBase(ledger_output_path, SourceDataBase.manifest_database_name)
+    return import_stored_account(account_db, manifest_db, account_data_path, account_import, 1)
+
 class SourceDataBase(JsonDataBase) :
-    
-    def __init__(self, hash_db : JsonDataBase, ledger_output_path : Path, account_imports : typing.List[AccountImport], account_data_path : Path) :
-        super().__init__(ledger_output_path, "BaseAccounts")
+
+    database_name = "BaseAccounts"
+    manifest_database_name = "ImportManifests"
+
+    def __init__(self, hash_db : JsonDataBase, ledger_output_path : Path, account_imports : typing.List[AccountImport], account_data_path : Path, storage_format : str = "json", import_workers : int = 0, import_processes : int = 1, eager : bool = True, progress : LoadProgress | None = None) :
+        super().__init__(ledger_output_path, SourceDataBase.database_name, storage_format)
         self.__cache = ObjectCacher(hash_db, "ImportedAccountHashes", Account())
+        self.__manifest_db = JsonDataBase(ledger_output_path, SourceDataBase.manifest_database_name)
+        self.__ledger_output_path = ledger_output_path
+        self.__storage_format = storage_format
         self.__account_data_path = account_data_path
+        self.__import_workers = import_workers
         self.__import_data_lookup = {}
 
         for account_import in account_imports :
             self.__import_data_lookup[account_import.account_name] = account_import
-        for account_import in account_imports :
+        if not eager :
+            #accounts are imported on first request
+            report_progress(progress, imported_stage, len(account_imports), len(account_imports))
+            return
+        report_progress(progress, imported_stage, 0, len(account_imports))
+        if import_processes != 1 :
+            self.__import_stale_accounts(import_processes)
+        for index, account_import in enumerate(account_imports) :
             self.get_account(account_import.account_name)
+            report_progress(progress, imported_stage, index + 1, len(account_imports))
+        self.flush()
 
     def __import_account(self, account_name : str) -> Account | None :
         account_import = self.__import_data_lookup[account_name]
-        account = get_imported_account(self.__account_data_path, account_import)
+        account, manifest = import_stored_account(self, self.__manifest_db, self.__account_data_path, account_import, self.__import_workers)
+        #manifest goes first, if the account write is lost the manifest no longer matches and the next import is a full one
+        self.__manifest_db.update(account_name, manifest)
         logger.info(f"Imported account {account_name}!")
         return account
-    
+
+    def __import_stale_accounts(self, import_processes : int) -> None :
+        stale_hashes = {}
+        for account_name in self.__import_data_lookup :
+            current_hash = self.get_account_hash(account_name)
+            if self.__cache.get_stored_hash(account_name) != current_hash :
+                stale_hashes[account_name] = current_hash
+        process_count = get_import_worker_count(import_processes, len(stale_hashes))
+        if process_count <= 1 :
+            return
+
+        logger.info(f"Importing {len(stale_hashes)} accounts on {process_count} processes")
+        imported_accounts = {}
+        with ProcessPoolExecutor(max_workers=process_count, mp_context=get_context("spawn")) as executor :
+            futures = {account_name : executor.submit(import_stored_account_process, self.__ledger_output_path, self.__storage_format, self.__account_data_path, self.__import_data_lookup[account_name]) for account_name in stale_hashes}
+            for account_name, future in futures.items() :
+                try :
+                    imported_accounts[account_name] = future.result()
+                except Exception as e :
+                    #left stale, get_account retries it in this process
+                    logger.error(f"Failed to import account {account_name} in process pool! {e}")
+
+        for account_name, (account, manifest) in imported_accounts.items() :
+            self.__manifest_db.update(account_name, manifest)
+            self.__cache.store_object(self, account_name, stale_hashes[account_name], account)
+            logger.info(f"Imported account {account_name}!")
+        self.flush()
+
+    def flush(self) -> None :
+        self.__cache.flush()
+
+    def get_account_names(self) -> typing.List[str] :
+        #configured accounts, whether imported yet or not
+        return sorted(self.__import_data_lookup.keys())
+
     def get_account_hash(self, account_name : str) -> str :
         account_import = self.__import_data_lookup[account_name]
         return get_imported_account_hash(self.__account_data_path, account_import)
 
+    def get_import_manifest(self, account_name : str) -> ImportManifest :
+        if self.__manifest_db.is_stored(account_name) :
+            return self.__manifest_db.retrieve(account_name, ImportManifest)
+        return ImportManifest()
+
+    def get_stored_account_hash(self, account_name : str) -> str :
+        #hash the stored account was built at, "0" if never built
+        return self.__cache.get_stored_hash(account_name)
+
     def get_account(self, account_name : str) -> Account :
         if account_name not in self.__import_data_lookup :
             logger.info(f"Account {account_name} not found in import data!")
@@ -39,3 +116,7 @@ class SourceDataBase(JsonDataBase) :
 
         current_hash = self.get_account_hash(account_name)
         return self.__cache.request_object(self, account_name, current_hash, self.__import_account)
+
+    def get_account_fingerprint(self, account_name : str) -> bytes :
+        #imported IDs depend on the order files arrived in, so anything built from the rows keys on the rows themselves
+        return get_transactions_fingerprint(self.get_account(account_name))
@@ -0,0 +1,23 @@
+import pathlib
+import argparse
+
+from Code.database import storage_formats
+from Code.ledger_database import get_ledger_configuration, convert_ledger_storage
+
+from Code.Utils.logger import get_logger
+logger = get_logger(__name__)
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Rewrites the stored accounts and ledger tables of every configured ledger in another storage format")
+    parser.add_argument("--data_directory", nargs=1, required=True, help="Root directory for ledger data and configuration settings", metavar="<Data Directory>", dest="data_directory")
+    parser.add_argument("--storage_format", default="parquet", choices=storage_formats, required=False, help="Storage format to convert to", dest="storage_format")
+
+    arguments = parser.parse_args()
+
+    data_root_directory = pathlib.Path(arguments.data_directory[0])
+    ledger_configuration = get_ledger_configuration(data_root_directory)
+    for ledger_import in ledger_configuration.ledgers :
+        print(f"Converting ledger {ledger_import.ledger_name} to {arguments.storage_format} ...")
+        convert_ledger_storage(data_root_directory, ledger_import, arguments.storage_format)
+        if ledger_import.storage_format != arguments.storage_format :
+            print(f"... set \"storage format\" : \"{arguments.storage_format}\" for {ledger_import.ledger_name} in LedgerConfiguration.json to use it")
@@ -0,0 +1,192 @@
+import typing
+import argparse
+from pathlib import Path
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from polars import DataFrame, Series, String, concat, col, lit
+
+from Code.Data.account_hashing import transaction_hash, make_identified_transaction_dataframe, ids_to_hex, get_id_words, id_word_columns
+from Code.Data.account_data import Account, AccountMapping, DerivedAccount
+from Code.Pipeline.transaction_classification import TransactionClassifier, get_matched_transactions
+from Code.Pipeline.account_importing import read_transactions_from_csv_in_path
+from Code.Pipeline.ledger_validation import get_unaccounted_transactions_frame
+from Code.database import JsonDataBase, storage_formats
+
+from Code.Utils.logger import get_logger
+logger = get_logger(__name__)
+
+def make_benchmark_transactions(row_count : int, seed : int = 0) -> DataFrame :
+    generator = Random(seed)
+    descriptions = ["GROCERY STORE #1234", "PAYROLL DEPOSIT", "TRANSFER TO SAVINGS", "COFFEE+CO (DOWNTOWN)", "E-TRANSFER"]
+    timestamps = sorted(float(generator.randint(1_500_000_000, 1_700_000_000)) for _ in range(row_count))
+    return DataFrame({
+        "date" : [f"2021-{generator.randint(1, 12):02d}-{generator.randint(1, 28):02d}" for _ in range(row_count)],
+        "delta" : [round(generator.uniform(-2000.0, 2000.0), 2) for _ in range(row_count)],
+        "description" : [generator.choice(descriptions) for _ in range(row_count)],
+        "timestamp" : timestamps
+        })
+
+def make_rowwise_identified_transaction_dataframe(transactions : DataFrame) -> DataFrame :
+    index = DataFrame(Series("TempIndex", range(0, transactions.height)))
+    indexed_transactions = concat([index, transactions], how="horizontal")
+    make_id = lambda t : transaction_hash(int(t[0]), t[1], t[4], t[2], t[3])
+    id_frame = indexed_transactions.map_rows(make_id, String)
+    id_frame.columns = ["ID"]
+    return concat([id_frame, transactions], how="horizontal")
+
+def time_rows_per_second(function : typing.Callable, transactions : DataFrame, repeats : int) -> float :
+    best_time = float("inf")
+    for _ in range(repeats) :
+        start_time = perf_counter()
+        function(transactions)
+        best_time = min(best_time, perf_counter() - start_time)
+    return transactions.height / best_time
+
+def benchmark_transaction_ids(row_count : int, repeats : int) -> None :
+    transactions = make_benchmark_transactions(row_count)
+    rowwise_ids = make_rowwise_identified_transaction_dataframe(transactions)["ID"]
+    compatible_ids = ids_to_hex(make_identified_transaction_dataframe(transactions)["ID"])
+    assert rowwise_ids.equals(compatible_ids), "Compatible transaction IDs differ from row-wise IDs!"
+
+    rates = {
+        "row-wise map_rows" : time_rows_per_second(make_rowwise_identified_transaction_dataframe, transactions, repeats),
+        "columnar compatible" : time_rows_per_second(make_identified_transaction_dataframe, transactions, repeats),
+        "columnar fast" : time_rows_per_second(lambda t : make_identified_transaction_dataframe(t, compatible=False), transactions, repeats)
+        }
+    print(f"Transaction IDs for {row_count} rows (best of {repeats}) :")
+    for name, rate in rates.items() :
+        print(f"\t{name:<24}{rate:>14,.0f} rows/s{rate / rates['row-wise map_rows']:>8.1f}x")
+
+def benchmark_account_loading(row_count : int, repeats : int) -> None :
+    account = Account("BenchmarkAccount", 0.0, make_identified_transaction_dataframe(make_benchmark_transactions(row_count)))
+    print(f"Account retrieve for {row_count} rows (best of {repeats}) :")
+    with TemporaryDirectory() as temporary_directory :
+        for storage_format in storage_formats :
+            database = JsonDataBase(Path(temporary_directory), storage_format, storage_format)
+            database.update(account.name, account)
+            rate = time_rows_per_second(lambda _ : database.retrieve(account.name, Account), account.transactions, repeats)
+            print(f"\t{storage_format:<24}{rate:>14,.0f} rows/s")
+
+def write_benchmark_csv_folder(folder_path : Path, transactions : DataFrame, file_count : int) -> None :
+    import_script = "def import_dataframe(path) :\n    from polars import read_csv, col\n    return read_csv(path).with_columns(col(\"TransDate\").str.to_date(\"%Y-%m-%d\"))\n"
+    (folder_path / "import_dataframe.py").write_text(import_script)
+    csv_frame = transactions.select(
+        TransDate=transactions["date"],
+        Description=transactions["description"],
+        Credit=-transactions["delta"].clip(upper_bound=0.0),
+        Debit=transactions["delta"].clip(lower_bound=0.0))
+    rows_per_file = -(-csv_frame.height // file_count)
+    for file_index in range(0, file_count) :
+        csv_frame.slice(file_index * rows_per_file, rows_per_file).write_csv(folder_path / f"{file_index:04d}.csv")
+
+def benchmark_csv_import(row_count : int, repeats : int) -> None :
+    file_count = 200
+    transactions = make_benchmark_transactions(row_count)
+    print(f"CSV import for {row_count} rows in {file_count} files (best of {repeats}) :")
+    with TemporaryDirectory() as temporary_directory :
+        folder_path = Path(temporary_directory)
+        write_benchmark_csv_folder(folder_path, transactions, file_count)
+        sequential_transactions = read_transactions_from_csv_in_path(folder_path, 1)
+        assert read_transactions_from_csv_in_path(folder_path).equals(sequential_transactions), "Parallel CSV import differs from sequential import!"
+        for import_workers in [1, 0] :
+            rate = time_rows_per_second(lambda _ : read_transactions_from_csv_in_path(folder_path, import_workers), transactions, repeats)
+            print(f"\t{'sequential' if import_workers == 1 else 'worker pool':<24}{rate:>14,.0f} rows/s")
+
+def make_benchmark_merchants(merchant_count : int, seed : int = 0) -> typing.List[str] :
+    generator = Random(seed)
+    syllables = ["MA", "KO", "RI", "TEL", "SUN", "VA", "LO", "PER", "ZEN", "CO"]
+    return [f"{''.join(generator.choice(syllables) for _ in range(0, 3))}{merchant_index}" for merchant_index in range(0, merchant_count)]
+
+def make_benchmark_mapping(merchants : typing.List[str], rule_count : int, seed : int = 0) -> AccountMapping :
+    generator = Random(seed)
+    account_mapping = AccountMapping()
+    for rule_index in range(0, rule_count) :
+        matching = DerivedAccount.Matching()
+        matching.account_name = ""
+        matching.strings = generator.sample(merchants, generator.randint(1, 3))
+        account_derivation = DerivedAccount()
+        account_derivation.name = f"Derived{rule_index}"
+        account_derivation.matchings = [matching]
+        account_mapping.derived_accounts.append(account_derivation)
+    return account_mapping
+
+def benchmark_classification(row_count : int, repeats : int) -> None :
+    generator = Random(0)
+    merchants = make_benchmark_merchants(1000)
+    transactions = make_benchmark_transactions(row_count)
+    transactions = transactions.with_columns(Series("description", [f"POS {generator.choice(merchants)} #{generator.randint(1, 50)}" for _ in range(0, row_count)]))
+    account = Account("BenchmarkAccount", 0.0, make_identified_transaction_dataframe(transactions))
+    account_mapping = make_benchmark_mapping(merchants, 200)
+    match_strings = [account_derivation.matchings[0].strings for account_derivation in account_mapping.derived_accounts]
+    classifier = TransactionClassifier(account_mapping)
+    for strings in match_strings :
+        assert classifier.get_matched_transactions(account, strings).equals(get_matched_transactions(account, strings)), f"Classifier differs from regex matching for {strings}!"
+
+    match_all_regex = lambda _ : [get_matched_transactions(account, strings) for strings in match_strings]
+    def match_all_classified(_ : DataFrame) -> typing.List[DataFrame] :
+        classifier = TransactionClassifier(account_mapping)
+        return [classifier.get_matched_transactions(account, strings) for strings in match_strings]
+    print(f"Matching {len(match_strings)} rules over {row_count} rows (best of {repeats}) :")
+    for name, function in [("regex per rule", match_all_regex), ("classifier", match_all_classified)] :
+        rate = time_rows_per_second(function, account.transactions, repeats)
+        print(f"\t{name:<24}{rate:>14,.0f} rows/s")
+
+def get_unaccounted_per_account(accounts : typing.List[Account], ledger_entries : DataFrame) -> DataFrame :
+    #one anti-join per account against every ledger ID, as before the single plan
+    accounted_transaction_ids = get_id_words(concat([ledger_entries["from_transaction_id"], ledger_entries["to_transaction_id"]])).unique()
+    unaccounted_frames = []
+    for account in accounts :
+        unaccounted_frames.append(account.transactions
+            .with_columns(col("ID").struct.unnest())
+            .join(accounted_transaction_ids, on=id_word_columns, how="anti")
+            .select(["date", "description", "delta"])
+            .with_columns(lit(account.name).alias("account")))
+    return concat(unaccounted_frames)
+
+def benchmark_unaccounted(row_count : int, repeats : int) -> None :
+    account_count = 4
+    accounts = []
+    entry_frames = []
+    for account_index in range(0, account_count) :
+        account = Account(f"BenchmarkAccount{account_index}", 0.0, make_identified_transaction_dataframe(make_benchmark_transactions(row_count // account_count, account_index)))
+        accounts.append(account)
+        #every other transaction is accounted for
+        accounted = account.transactions.gather_every(2)
+        entry_frames.append(DataFrame({
+            "from_account_name" : Series([account.name] * accounted.height, dtype=String),
+            "from_transaction_id" : accounted["ID"],
+            "to_account_name" : Series(["BenchmarkDerived"] * accounted.height, dtype=String),
+            "to_transaction_id" : make_identified_transaction_dataframe(accounted.drop("ID"), first_index=row_count)["ID"],
+            "delta" : accounted["delta"].abs()
+            }))
+    ledger_entries = concat(entry_frames)
+    assert get_unaccounted_per_account(accounts, ledger_entries).equals(get_unaccounted_transactions_frame(accounts, [ledger_entries])), "Single plan differs from per account anti-joins!"
+
+    print(f"Filtering unaccounted transactions of {account_count} accounts over {row_count} rows (best of {repeats}) :")
+    for name, function in [("anti-join per account", lambda _ : get_unaccounted_per_account(accounts, ledger_entries)), ("single streaming plan", lambda _ : get_unaccounted_transactions_frame(accounts, [ledger_entries]))] :
+        rate = time_rows_per_second(function, concat([account.transactions for account in accounts]), repeats)
+        print(f"\t{name:<24}{rate:>14,.0f} rows/s")
+
+benchmarks = {
+    "transaction_ids" : benchmark_transaction_ids,
+    "account_loading" : benchmark_account_loading,
+    "csv_import" : benchmark_csv_import,
+    "classification" : benchmark_classification,
+    "unaccounted" : benchmark_unaccounted
+}
+
+if __name__ == "__main__" :
+    parser = argparse.ArgumentParser(description="Runs timing benchmarks on StockedUp pipeline stages")
+    parser.add_argument("--rows", type=int, default=200_000, required=False, help="Number of synthetic transactions per benchmark", dest="rows")
+    parser.add_argument("--repeats", type=int, default=3, required=False, help="Number of timed runs, best is reported", dest="repeats")
+    parser.add_argument("benchmark_names", nargs="*", help=f"Benchmarks to run from {list(benchmarks.keys())}, all by default", metavar="<Benchmark>")
+
+    arguments = parser.parse_args()
+
+    benchmark_names = arguments.benchmark_names if len(arguments.benchmark_names) > 0 else list(benchmarks.keys())
+    for benchmark_name in benchmark_names :
+        if benchmark_name in benchmarks :
+            benchmarks[benchmark_name](arguments.rows, arguments.repeats)
+        else :
+            logger.error(f"Unknown benchmark {benchmark_name}!")